@@ -1,25 +1,59 @@
 # db.py
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Float, Text, DateTime, ForeignKey
+    create_engine, event, func, Column, Integer, String, Float, Text, DateTime,
+    ForeignKey, LargeBinary, UniqueConstraint
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from datetime import datetime
+import zstandard as zstd
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
+import hashlib
 import os
+import orjson
 from sqlalchemy import JSON
 
-os.makedirs("data", exist_ok=True)
-
 # SQLite 會在 data/app.db 這個檔案裡存資料
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))   # backend/
 DB_PATH = os.path.join(BASE_DIR, "data", "app.db")
+os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 
 # 建立 Engine（負責跟 DB 溝通的主連線物件）
-engine = create_engine(DATABASE_URL, echo=False, future=True)
+# check_same_thread=False：讓 fetch_reviews_batch 的執行緒池可以共用連線
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    future=True,
+    connect_args={"check_same_thread": False},
+    # 連線池按執行緒數上調：抓評論的 worker（FETCH_WORKERS，預設 12）
+    # 加上背景寫入池可能同時各占一條連線，預設的 5+10 在尖峰時會讓
+    # 執行緒卡在等連線；SQLite 開本地檔案的成本低，多備幾條無妨
+    pool_size=16,
+    max_overflow=8,
+    # JSON 欄位改用 orjson 序列化：比 stdlib json 快 3~5 倍
+    json_serializer=lambda obj: orjson.dumps(obj).decode("utf-8"),
+    json_deserializer=orjson.loads,
+)
+
+
+# SQLite 效能調校：每條連線建立時設定 PRAGMA
+# - WAL：寫入時讀取不會被擋住（多執行緒爬蟲 + 寫入併行）
+# - synchronous=NORMAL：搭配 WAL 可大幅減少每次 commit 的 fsync 成本
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_conn, _connection_record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
 
 # 建立 Session 類別
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# scoped_session：每個執行緒重複使用同一個 Session / 連線，
+# 避免 fetch_reviews_batch 的 worker 每次呼叫都重新建連線、重放 PRAGMA
+SessionLocal = scoped_session(
+    sessionmaker(bind=engine, autoflush=False, autocommit=False)
+)
 
 # Base：所有資料表 model 的基礎類別
 Base = declarative_base()
@@ -35,12 +69,20 @@ class Restaurant(Base):
     address = Column(String(512))
     rating = Column(Float)
     user_ratings_total = Column(Integer)
+    # 上次「寫入評論」當下的 Google 評論總數：快取失效比對的基準。
+    # user_ratings_total 每次搜尋都會被 UPSERT 覆寫成最新值，拿它比對
+    # 等於自己跟自己比；這欄只在 replace_reviews_in_db 寫入評論時更新
+    user_ratings_total_at_scrape = Column(Integer)
     phone = Column(String(64))
     website = Column(String(512))
     map_url = Column(String(512))
-    last_update = Column(DateTime, default=datetime.utcnow)
+    # 時間戳交給 SQLite 端計算（CURRENT_TIMESTAMP 為 UTC），
+    # 批次寫入時不必每列在 Python 產生 datetime 物件
+    last_update = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
     # 一間餐廳有很多評論：一對多關係
+    # 維持預設 lazy load：熱路徑都改走裸欄位查詢，不經過這個 relationship，
+    # eager load 只會在載入 Restaurant 時多抓一整批用不到的評論（含 embedding）
     reviews = relationship("Review", back_populates="restaurant")
 
 
@@ -49,25 +91,140 @@ class Review(Base):
     __tablename__ = "reviews"
 
     id = Column(Integer, primary_key=True, index=True)
-    restaurant_id = Column(Integer, ForeignKey("restaurants.id"))  # 關聯到 Restaurant.id
+    # 關聯到 Restaurant.id；加上索引讓「刪掉某間餐廳所有評論」不用全表掃描
+    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), index=True)
     text = Column(Text)
+    # 評論內文的短雜湊：讓重複抓取時只寫入有變動的評論（差異更新）
+    text_hash = Column(String(16), index=True)
     stars = Column(Float)
+    # 句向量快取：float16 bytes（MiniLM 384 維），快取命中時不必重跑 encoder
+    embedding = Column(LargeBinary)
+
+    __table_args__ = (
+        UniqueConstraint("restaurant_id", "text_hash", name="uq_reviews_restaurant_text"),
+    )
 
     restaurant = relationship("Restaurant", back_populates="reviews")
 
 
+def review_text_hash(text) -> str:
+    """計算評論內文的短雜湊（差異更新用的唯一鍵）"""
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=8).hexdigest()
+
+
 # 定義「推薦紀錄」資料表（recommendations）
 class Recommendation(Base):
     __tablename__ = "recommendations"
 
     id = Column(Integer, primary_key=True, index=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=func.now())
     user_input = Column(Text)      # 使用者原始輸入句子
     location = Column(String(128)) 
     category = Column(String(64))  # 類別（咖啡、燒肉…）
-    top_place_ids = Column(String(512))  # 用逗號串起來的 place_id 列表
-    recommendation_json = Column(JSON)  # 存完整推薦結果(JSON)
+    # 前三名 place_id：JSON 陣列（engine 掛了 orjson 序列化），
+    # 讀取端直接拿回 list，不用再 split(",") 重新解析
+    top_place_ids = Column(JSON)
+    # 存完整推薦結果：orjson + zstd 壓縮後的 BLOB（含摘要與理由，可達數十 KB）
+    recommendation_json = Column(LargeBinary)
+
+
+# 推薦 JSON 的壓縮 / 解壓工具（level=3 在速度與壓縮率間取得平衡）
+_zstd_compressor = zstd.ZstdCompressor(level=3)
+_zstd_decompressor = zstd.ZstdDecompressor()
+
+
+def dump_recommendation_json(obj) -> bytes:
+    """把推薦結果序列化並壓縮成可寫入 recommendation_json 的 bytes"""
+    return _zstd_compressor.compress(orjson.dumps(obj))
+
+
+def load_recommendation_json(blob):
+    """解開 recommendation_json 欄位，還原成 Python 物件"""
+    if blob is None:
+        return None
+    return orjson.loads(_zstd_decompressor.decompress(blob))
 
 # 9. 建立資料表用的函式
+_DB_READY = False
+
+
+def _migrate_schema():
+    """舊資料庫就地升級（create_all 只建新表，不會 ALTER 既有資料表）
+
+    針對既有安裝補上後來新增的欄位與索引：
+    - restaurants.user_ratings_total_at_scrape（總數比對失效判斷的基準）
+    - reviews.text_hash / reviews.embedding（缺了會讓評論快取整個失效）
+    - 舊列回填 text_hash 並去重，差異更新的 UPSERT 需要唯一索引才能運作
+    - recommendations 舊格式（逗號字串 + 未壓縮 TEXT）不相容，
+      純歷史紀錄表，直接汰換重建
+    """
+    with engine.begin() as conn:
+        rest_cols = {
+            row[1] for row in
+            conn.exec_driver_sql("PRAGMA table_info(restaurants)").fetchall()
+        }
+        if rest_cols and "user_ratings_total_at_scrape" not in rest_cols:
+            conn.exec_driver_sql(
+                "ALTER TABLE restaurants ADD COLUMN user_ratings_total_at_scrape INTEGER"
+            )
+            # 舊列以現有總數當基準值：不完全精準，但讓總數比對立刻可用，
+            # 之後第一次重爬就會校正
+            conn.exec_driver_sql(
+                "UPDATE restaurants SET user_ratings_total_at_scrape = user_ratings_total"
+            )
+
+        cols = {
+            row[1] for row in
+            conn.exec_driver_sql("PRAGMA table_info(reviews)").fetchall()
+        }
+        if cols:
+            if "text_hash" not in cols:
+                conn.exec_driver_sql(
+                    "ALTER TABLE reviews ADD COLUMN text_hash VARCHAR(16)"
+                )
+            if "embedding" not in cols:
+                conn.exec_driver_sql("ALTER TABLE reviews ADD COLUMN embedding BLOB")
+            # 舊列補雜湊：保留既有評論快取的價值（embedding 留空，用到時再編）
+            rows = conn.exec_driver_sql(
+                "SELECT id, text FROM reviews WHERE text_hash IS NULL"
+            ).fetchall()
+            if rows:
+                conn.exec_driver_sql(
+                    "UPDATE reviews SET text_hash = ? WHERE id = ?",
+                    [(review_text_hash(text), rid) for rid, text in rows],
+                )
+            # 同餐廳同文的重複列只留一筆，否則唯一索引建不起來
+            conn.exec_driver_sql(
+                "DELETE FROM reviews WHERE id NOT IN "
+                "(SELECT MIN(id) FROM reviews GROUP BY restaurant_id, text_hash)"
+            )
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_reviews_restaurant_id "
+                "ON reviews (restaurant_id)"
+            )
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_reviews_text_hash ON reviews (text_hash)"
+            )
+            # SQLite 的 ALTER 加不了表層級約束，用唯一索引達到同樣效果
+            # （on_conflict_do_update 認得唯一索引）
+            conn.exec_driver_sql(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_reviews_restaurant_text "
+                "ON reviews (restaurant_id, text_hash)"
+            )
+
+        rec_cols = {
+            row[1]: (row[2] or "").upper() for row in
+            conn.exec_driver_sql("PRAGMA table_info(recommendations)").fetchall()
+        }
+        if rec_cols and rec_cols.get("recommendation_json") != "BLOB":
+            conn.exec_driver_sql("DROP TABLE recommendations")
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # 建過一次就不再重跑，避免每次呼叫都去掃 sqlite_master
+    global _DB_READY
+    if _DB_READY:
+        return
+    _migrate_schema()
+    Base.metadata.create_all(bind=engine, checkfirst=True)
+    _DB_READY = True
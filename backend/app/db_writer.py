@@ -1,7 +1,10 @@
 # db_writer.py
-import datetime
-from db import SessionLocal, Restaurant, Review, Recommendation
-import json 
+from .db import (
+    SessionLocal, Restaurant, Review, Recommendation,
+    review_text_hash, dump_recommendation_json,
+)
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 def upsert_restaurant(info: dict):
     """
@@ -18,54 +21,148 @@ def upsert_restaurant(info: dict):
         "map_url": "..."
       }
     """
-    db = SessionLocal()
-    place_id = info["place_id"]
+    # SQLite 原生 UPSERT：一條 INSERT ... ON CONFLICT(place_id) DO UPDATE
+    # 取代 SELECT 後再分支 INSERT / UPDATE 的兩次來回
+    values = {
+        "place_id": info["place_id"],
+        "name": info.get("name"),
+        "address": info.get("address"),
+        "rating": info.get("rating"),
+        "user_ratings_total": info.get("user_ratings_total"),
+        "phone": info.get("phone"),
+        "website": info.get("website"),
+        "map_url": info.get("map_url"),
+    }
+    stmt = sqlite_insert(Restaurant).values(**values)
+    set_ = {k: stmt.excluded[k] for k in values if k != "place_id"}
+    # 新增列由 server_default 產生時間戳；更新列由 SQLite 端重算
+    set_["last_update"] = func.now()
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["place_id"],
+        set_=set_,
+    ).returning(Restaurant.id)
 
-    restaurant = db.query(Restaurant).filter_by(place_id=place_id).first()
-    if not restaurant:
-        restaurant = Restaurant(place_id=place_id)
-        db.add(restaurant)
+    # 用 context manager 管理 session 與 transaction：
+    # 全部操作包在同一個 transaction，commit 時只做一次 fsync
+    # 回傳內部 id，讓呼叫端可直接傳給 upsert_reviews 省掉一次 SELECT
+    with SessionLocal() as db:
+        with db.begin():
+            return db.execute(stmt).scalar_one()
 
-    restaurant.name = info.get("name")
-    restaurant.address = info.get("address")
-    restaurant.rating = info.get("rating")
-    restaurant.user_ratings_total = info.get("user_ratings_total")
-    restaurant.phone = info.get("phone")
-    restaurant.website = info.get("website")
-    restaurant.map_url = info.get("map_url")
-    restaurant.last_update = datetime.datetime.utcnow()
 
-    db.commit()
-    db.close()
+def upsert_restaurants_bulk(infos: list):
+    """
+    一次寫入多間餐廳（單一 transaction + 單一 UPSERT executemany）。
+    infos: list[dict]，每個 dict 格式同 upsert_restaurant 的 info
+    """
+    if not infos:
+        return
+
+    rows = [
+        {
+            "place_id": info["place_id"],
+            "name": info.get("name"),
+            "address": info.get("address"),
+            "rating": info.get("rating"),
+            "user_ratings_total": info.get("user_ratings_total"),
+            "phone": info.get("phone"),
+            "website": info.get("website"),
+            "map_url": info.get("map_url"),
+        }
+        for info in infos
+    ]
+    stmt = sqlite_insert(Restaurant)
+    set_ = {k: stmt.excluded[k] for k in rows[0] if k != "place_id"}
+    set_["last_update"] = func.now()
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["place_id"],
+        set_=set_,
+    )
+
+    with SessionLocal() as db:
+        with db.begin():
+            db.execute(stmt, rows)
+
+
+def upsert_reviews_bulk(reviews_by_place: dict):
+    """
+    一次替換多間餐廳的評論（單一 transaction，只 commit / fsync 一次）。
+    reviews_by_place: {place_id: [{"text": "...", "stars": 5.0}, ...]}
+    """
+    if not reviews_by_place:
+        return
 
+    with SessionLocal() as db:
+        with db.begin():
+            id_rows = (
+                db.query(Restaurant.id, Restaurant.place_id)
+                .filter(Restaurant.place_id.in_(reviews_by_place.keys()))
+                .all()
+            )
+            id_by_place = {place_id: rid for rid, place_id in id_rows}
 
-def upsert_reviews(place_id: str, reviews: list):
+            for place_id, reviews in reviews_by_place.items():
+                if place_id in id_by_place:
+                    _apply_review_delta(db, id_by_place[place_id], reviews)
+
+
+def upsert_reviews(place_id: str, reviews: list, restaurant_id: int = None):
     """
     reviews:
       [
         {"text": "...", "stars": 5.0},
         {"text": "...", "stars": 4.0},
       ]
+    restaurant_id: 若呼叫端已有內部 id（upsert_restaurant 的回傳值），
+                   直接傳入可省掉 place_id -> id 的那次 SELECT
     """
-    db = SessionLocal()
-    restaurant = db.query(Restaurant).filter_by(place_id=place_id).first()
-    if not restaurant:
-        db.close()
-        return
+    with SessionLocal() as db:
+        with db.begin():
+            if restaurant_id is None:
+                restaurant_id = (
+                    db.query(Restaurant.id)
+                    .filter_by(place_id=place_id)
+                    .scalar()
+                )
+                if restaurant_id is None:
+                    return
+
+            _apply_review_delta(db, restaurant_id, reviews)
+
 
-    # 清空舊評論
-    db.query(Review).filter_by(restaurant_id=restaurant.id).delete()
+def _apply_review_delta(db, restaurant_id: int, reviews: list):
+    """
+    差異更新單間餐廳的評論：
+    - 以 (restaurant_id, text_hash) 為唯一鍵做 UPSERT，沒變的評論不重寫
+    - 只刪除這次抓取已消失的評論，而不是整批 DELETE 再重建
+    """
+    rows = []
+    hashes = set()
+    for rv in reviews or []:
+        h = review_text_hash(rv.get("text"))
+        if h in hashes:
+            continue
+        hashes.add(h)
+        rows.append({
+            "restaurant_id": restaurant_id,
+            "text": rv.get("text"),
+            "text_hash": h,
+            "stars": rv.get("stars"),
+        })
 
-    # 新增評論
-    for rv in reviews:
-        db.add(Review(
-            restaurant_id=restaurant.id,
-            text=rv.get("text"),
-            stars=rv.get("stars")
-        ))
+    # 刪掉這次沒再出現的舊評論
+    stale = db.query(Review).filter(Review.restaurant_id == restaurant_id)
+    if hashes:
+        stale = stale.filter(Review.text_hash.notin_(hashes))
+    stale.delete(synchronize_session=False)
 
-    db.commit()
-    db.close()
+    if rows:
+        stmt = sqlite_insert(Review)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["restaurant_id", "text_hash"],
+            set_={"stars": stmt.excluded.stars},
+        )
+        db.execute(stmt, rows)
 
 def insert_recommendation(user_input, location, category, ranked):
     """
@@ -74,7 +171,6 @@ def insert_recommendation(user_input, location, category, ranked):
       1. 前三名的 place_id 存在 top_place_ids
       2. 排序後後資料 用 JSON 存在 recommendation_json (含全部評估分數)
     """
-    db = SessionLocal()
     try:
         top3 = [r.get("place_id") for r in ranked[:3] if r.get("place_id")]
 
@@ -82,16 +178,13 @@ def insert_recommendation(user_input, location, category, ranked):
             user_input=user_input,
             location=location,
             category=category,
-            top_place_ids=",".join(top3),
-            recommendation_json=json.dumps(ranked, ensure_ascii=False), 
+            top_place_ids=top3,
+            # orjson 序列化一次後用 zstd 壓縮，縮小列大小與 commit 的 fsync 量
+            recommendation_json=dump_recommendation_json(ranked),
         )
-        db.add(rec)
-        db.commit()
+        with SessionLocal() as db:
+            with db.begin():
+                db.add(rec)
         print("[insert_recommendation] 已寫入 Recommendation（含完整推薦 JSON）")
     except Exception as e:
-        db.rollback()
         print("[insert_recommendation] 發生錯誤：", e)
-    finally:
-        db.close()
-
-
@@ -15,58 +15,75 @@ RecommendAgent
 每個節點負責特定的處理邏輯，透過條件路由實現靈活的流程控制。
 """
 
+import os
 import re
-import json
+import atexit
+import hashlib
+import logging
+import functools
+import time
 import datetime
+import threading
+import unicodedata
 import concurrent.futures
 from typing import Optional, List, Dict, Any
 
-from pydantic import BaseModel, Field
+import numpy as np
+
+from pydantic import BaseModel, ConfigDict, Field
 from langgraph.graph import StateGraph, START, END
 
 # 工具模組
 from recommender.tools.place_info_tool import search_restaurants, location_is_too_large
 from recommender.tools.review_scraper_tool import get_all_reviews
-from recommender.tools.embedding_tool import analyze_reviews
-from recommender.tools.gemini_tool import call_gemini, generate_reason
+from recommender.tools.embedding_tool import (
+    analyze_reviews, analyze_reviews_batch, encode_texts, EMBED_DIM,
+)
+from recommender.tools.gemini_tool import (
+    call_gemini_json, generate_reason, generate_reasons_batch,
+)
 
 # 資料庫模型
-from app.db import SessionLocal, Restaurant, Review, Recommendation
+from app.db import (
+    SessionLocal, Restaurant, Review, Recommendation,
+    dump_recommendation_json, review_text_hash,
+)
+from app.db_writer import upsert_restaurants_bulk
+
+# 模組 logger：預設 WARNING，開發時用 LOG_LEVEL=DEBUG 打開逐步紀錄。
+# 熱路徑（worker 執行緒）不再經過 print 的同步 stdout flush
+log = logging.getLogger(__name__)
+log.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
 
 
 # ============================================================
 # 資料庫輔助函式（保持不變）
 # ============================================================
 
-def upsert_restaurant_from_dict(info: Dict[str, Any]) -> Optional[Restaurant]:
+def sync_restaurant_and_get_fresh_reviews(
+    info: Dict[str, Any],
+    cache_days: int,
+    skip_upsert: bool = False,
+) -> Optional[List[Dict[str, Any]]]:
     """
-    新增或更新餐廳資料至資料庫
-    
-    功能說明：
-    - 根據 place_id 檢查餐廳是否已存在
-    - 若不存在則新增，若存在則更新資訊
-    - 更新 last_update 時間戳記以追蹤資料新鮮度
-    
+    單一 session 完成餐廳寫入 + 快取新鮮度檢查 + 評論載入
+
+    fetch_single 原本把餐廳 UPSERT 與快取查詢拆成兩個函式，各自開
+    session、各自用 place_id 查一次餐廳。這裡合併成一條連線、一次
+    SELECT：查出的餐廳列直接拿來更新欄位與判斷新鮮度，評論也在
+    同一個 transaction 裡載入。
+
     參數：
-        info: 包含餐廳資訊的字典，必須包含 place_id
-        
+        info: 餐廳資訊字典（格式同 db_writer.upsert_restaurant 的 info）
+        cache_days: 快取有效天數
+        skip_upsert: 呼叫端已寫入過餐廳基本資料時設 True
+
     返回：
-        Restaurant: 更新後的餐廳物件，若操作失敗則返回 None
-        
-    資料庫欄位：
-        - place_id: Google Places API 的唯一識別碼
-        - name: 餐廳名稱
-        - address: 地址
-        - rating: 平均評分（1-5）
-        - user_ratings_total: 總評論數
-        - phone: 聯絡電話
-        - website: 官方網站
-        - map_url: Google Maps 連結
-        - last_update: 最後更新時間（UTC）
+        List[Dict]: 新鮮的快取評論（含 embedding 欄位）
+        None: 無快取、已過期或發生錯誤（呼叫端應走爬取路徑）
     """
     place_id = info.get("place_id")
     if not place_id:
-        print("[upsert_restaurant_from_dict] 缺少 place_id，略過寫入餐廳資料")
         return None
 
     db = SessionLocal()
@@ -76,111 +93,163 @@ def upsert_restaurant_from_dict(info: Dict[str, Any]) -> Optional[Restaurant]:
             .filter(Restaurant.place_id == place_id)
             .first()
         )
-        if restaurant is None:
-            restaurant = Restaurant(place_id=place_id)
-            db.add(restaurant)
-
-        restaurant.name = info.get("name")
-        restaurant.address = info.get("address")
-        restaurant.rating = info.get("rating")
-        restaurant.user_ratings_total = info.get("user_ratings_total")
-        restaurant.phone = info.get("phone")
-        restaurant.website = info.get("website")
-        restaurant.map_url = info.get("map_url")
-        restaurant.last_update = datetime.datetime.utcnow()
+        # 失效比對的基準是「上次寫入評論時」的總數：user_ratings_total
+        # 在 place_search_node 的整批 UPSERT 就被蓋成最新值了，不能拿來比
+        cached_total = (
+            restaurant.user_ratings_total_at_scrape if restaurant else None
+        )
 
-        db.commit()
-        db.refresh(restaurant)
-        print(f"[upsert_restaurant_from_dict] 已寫入餐廳：{restaurant.name} ({place_id})")
-        return restaurant
+        if not skip_upsert:
+            if restaurant is None:
+                restaurant = Restaurant(place_id=place_id)
+                db.add(restaurant)
+            restaurant.name = info.get("name")
+            restaurant.address = info.get("address")
+            restaurant.rating = info.get("rating")
+            restaurant.user_ratings_total = info.get("user_ratings_total")
+            restaurant.phone = info.get("phone")
+            restaurant.website = info.get("website")
+            restaurant.map_url = info.get("map_url")
+            restaurant.last_update = datetime.datetime.utcnow()
+            db.commit()
+
+        if restaurant is None or restaurant.id is None or restaurant.last_update is None:
+            return None
+
+        # 失效判斷改以 Google 回報的評論總數為主：搜尋結果本來就帶
+        # user_ratings_total，和上次爬取當下的總數一樣代表沒有新評論，
+        # 快取再舊也能直接用；變了就立刻重爬，不必等 TTL 到期。
+        # 比不出來（任一邊缺總數）才退回 TTL 天數
+        incoming_total = info.get("user_ratings_total")
+        if incoming_total and cached_total:
+            if incoming_total != cached_total:
+                log.debug(
+                    "[sync_restaurant_and_get_fresh_reviews] %s 評論總數 %s → %s，重新爬取",
+                    restaurant.name, cached_total, incoming_total,
+                )
+                return None
+        else:
+            diff_days = (datetime.datetime.utcnow() - restaurant.last_update).days
+            if diff_days > cache_days:
+                log.debug(
+                    "[sync_restaurant_and_get_fresh_reviews] %s 已超過 %s 天，不使用快取",
+                    restaurant.name, cache_days,
+                )
+                return None
+
+        review_rows = (
+            db.query(Review.text, Review.stars, Review.embedding)
+            .filter(Review.restaurant_id == restaurant.id)
+            .all()
+        )
+        if not review_rows:
+            return None
+
+        return [
+            {"text": text, "stars": stars, "embedding": embedding}
+            for text, stars, embedding in review_rows
+        ]
     except Exception as e:
         db.rollback()
-        print("[upsert_restaurant_from_dict] 資料庫錯誤：", e)
+        log.error("[sync_restaurant_and_get_fresh_reviews] 資料庫錯誤：%s", e)
         return None
     finally:
         db.close()
 
 
-def get_cached_reviews_if_fresh(place_id: str, cache_days: int) -> Optional[List[Dict[str, Any]]]:
+def batch_load_fresh_reviews(
+    place_ids: List[str],
+    cache_days: int,
+    totals: Optional[Dict[str, int]] = None,
+) -> Dict[str, List[Dict[str, Any]]]:
     """
-    檢查並取得快取的餐廳評論（若資料夠新鮮）
-    
-    快取策略說明：
-    - 透過 last_update 時間判斷資料新鮮度
-    - 若距離上次更新未超過 cache_days 天數，則使用快取資料
-    - 若超過時限或無快取，則返回 None 以觸發重新爬取
-    
-    參數：
-        place_id: Google Places API 的餐廳唯一識別碼
-        cache_days: 快取有效天數，超過此天數將不使用快取
-        
-    返回：
-        List[Dict]: 評論列表，每個評論包含 text 和 stars 欄位
-        None: 無可用快取或資料已過期
-        
-    效能優化：
-    - 減少重複爬取，降低 API 呼叫次數
-    - 提升系統回應速度
-    - 節省網路頻寬和運算資源
+    一次載入多間餐廳的新鮮快取評論（sync_restaurant_and_get_fresh_reviews
+    的唯讀批次版）
+
+    用單一 session 發兩條 IN 查詢：
+    1. 撈出快取仍有效的餐廳
+    2. 撈出這些餐廳的全部評論，在 Python 端按 place_id 分組
+
+    失效判斷同 sync_restaurant_and_get_fresh_reviews：呼叫端若透過
+    totals 傳入 Google 回報的評論總數，和上次爬取當下的總數
+    （user_ratings_total_at_scrape）比對——沒變就不管 TTL 直接用、
+    變了立刻視為過期，比不出來才退回 TTL 天數。
+
+    取代逐間開 session 查詢的 N+1 模式；不在結果裡的 place_id
+    就是快取未命中（或沒有評論），由呼叫端走爬取路徑。
     """
+    if not place_ids:
+        return {}
+
     db = SessionLocal()
     try:
-        restaurant = (
-            db.query(Restaurant)
-            .filter(Restaurant.place_id == place_id)
-            .first()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=cache_days)
+        rows = (
+            db.query(
+                Restaurant.id, Restaurant.place_id,
+                Restaurant.last_update, Restaurant.user_ratings_total_at_scrape,
+            )
+            .filter(Restaurant.place_id.in_(place_ids))
+            .all()
         )
-        if restaurant is None or restaurant.last_update is None:
-            print("[get_cached_reviews_if_fresh] 找不到餐廳或沒有 last_update，略過快取")
-            return None
 
-        diff_days = (datetime.datetime.utcnow() - restaurant.last_update).days
-        print(
-            f"[get_cached_reviews_if_fresh] {restaurant.name} 上次更新日：{restaurant.last_update.date()}，距今 {diff_days} 天"
+        place_by_id = {}
+        for rid, pid, last_update, cached_total in rows:
+            incoming_total = (totals or {}).get(pid)
+            if incoming_total and cached_total:
+                if incoming_total == cached_total:
+                    place_by_id[rid] = pid
+                continue
+            if last_update is not None and last_update >= cutoff:
+                place_by_id[rid] = pid
+        if not place_by_id:
+            return {}
+        review_rows = (
+            db.query(Review.restaurant_id, Review.text, Review.stars, Review.embedding)
+            .filter(Review.restaurant_id.in_(place_by_id.keys()))
+            .all()
         )
-        if diff_days > cache_days:
-            print(f"[get_cached_reviews_if_fresh] 已超過 {cache_days} 天，不使用快取")
-            return None
-
-        review_rows = db.query(Review).filter(Review.restaurant_id == restaurant.id).all()
-        if not review_rows:
-            print("[get_cached_reviews_if_fresh] 沒有評論紀錄，不使用快取")
-            return None
 
-        reviews = [
-            {"text": row.text, "stars": row.stars}
-            for row in review_rows
-        ]
-        print(f"[get_cached_reviews_if_fresh] 使用資料庫快取評論數量：{len(reviews)}")
-        return reviews
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for rid, text, stars, embedding in review_rows:
+            grouped.setdefault(place_by_id[rid], []).append(
+                {"text": text, "stars": stars, "embedding": embedding}
+            )
+        return grouped
     except Exception as e:
-        print("[get_cached_reviews_if_fresh] 資料庫錯誤：", e)
-        return None
+        log.error("[batch_load_fresh_reviews] 資料庫錯誤：%s", e)
+        return {}
     finally:
         db.close()
 
 
-def replace_reviews_in_db(place_id: str, reviews: List[Dict[str, Any]]) -> None:
+def replace_reviews_in_db(
+    place_id: str,
+    reviews: List[Dict[str, Any]],
+    user_ratings_total: Optional[int] = None,
+) -> None:
     """
     替換資料庫中特定餐廳的所有評論
-    
+
     操作流程：
     1. 根據 place_id 找到對應的餐廳
     2. 刪除該餐廳所有舊評論
     3. 批次寫入新的評論資料
     4. 執行資料庫 commit 確保資料一致性
-    
+
     參數：
         place_id: 餐廳的唯一識別碼
         reviews: 新的評論列表，每個評論需包含 text 和 stars
-        
+        user_ratings_total: 這次爬取當下 Google 回報的評論總數；
+            存進 user_ratings_total_at_scrape 當之後失效比對的基準
+
     設計考量：
     - 採用完整替換而非增量更新，確保資料一致性
     - 使用事務機制，失敗時自動回滾
     - 避免重複評論累積
     """
     if not place_id:
-        print("[replace_reviews_in_db] 缺少 place_id，無法寫入評論")
+        log.debug("[replace_reviews_in_db] 缺少 place_id，無法寫入評論")
         return
 
     db = SessionLocal()
@@ -191,30 +260,55 @@ def replace_reviews_in_db(place_id: str, reviews: List[Dict[str, Any]]) -> None:
             .first()
         )
         if restaurant is None:
-            print("[replace_reviews_in_db] 找不到對應餐廳，略過評論寫入")
+            log.debug("[replace_reviews_in_db] 找不到對應餐廳，略過評論寫入")
             return
 
+        # 記下爬取當下的總數：只有這裡會寫這個欄位，
+        # 搜尋結果的 UPSERT 不會動它，失效比對才有固定基準
+        restaurant.user_ratings_total_at_scrape = user_ratings_total
+
         deleted = (
             db.query(Review)
             .filter(Review.restaurant_id == restaurant.id)
             .delete()
         )
-        print(f"[replace_reviews_in_db] 已刪除舊評論數量：{deleted}")
+        log.debug("[replace_reviews_in_db] 已刪除舊評論數量：%s", deleted)
+
+        # 寫入時就把句向量一次批次算好存進 DB，
+        # 之後同餐廳的查詢走快取路徑時完全不必重跑 encoder
+        texts = [rv.get("text") or "" for rv in reviews]
+        emb_matrix = encode_texts([t for t in texts if t])
+        emb_iter = iter(emb_matrix) if emb_matrix is not None else None
+
+        rows = []
+        seen_hashes = set()
+        for rv, text in zip(reviews, texts):
+            emb_bytes = None
+            if text and emb_iter is not None:
+                emb_bytes = next(emb_iter).tobytes()
+            # 同文重複的評論略過，避免違反 (restaurant_id, text_hash) 唯一鍵
+            h = review_text_hash(text)
+            if h in seen_hashes:
+                continue
+            seen_hashes.add(h)
+            rows.append({
+                "restaurant_id": restaurant.id,
+                "text": text,
+                "text_hash": h,
+                "stars": rv.get("stars"),
+                "embedding": emb_bytes,
+            })
 
-        for rv in reviews:
-            text = rv.get("text") or ""
-            stars = rv.get("stars")
-            db.add(Review(
-                restaurant_id=restaurant.id,
-                text=text,
-                stars=stars,
-            ))
+        # 批次寫入：單一 executemany INSERT，
+        # 不經過逐物件 db.add 的 unit-of-work 簿記
+        if rows:
+            db.bulk_insert_mappings(Review, rows)
 
         db.commit()
-        print(f"[replace_reviews_in_db] 已寫入新評論數量：{len(reviews)}")
+        log.debug("[replace_reviews_in_db] 已寫入新評論數量：%s", len(reviews))
     except Exception as e:
         db.rollback()
-        print("[replace_reviews_in_db] 資料庫錯誤：", e)
+        log.error("[replace_reviews_in_db] 資料庫錯誤：%s", e)
     finally:
         db.close()
 
@@ -247,76 +341,218 @@ def insert_recommendation_record(
     """
     db = SessionLocal()
     try:
-        top_ids = []
-        for r in ranked[:3]:
-            pid = r.get("place_id")
-            if pid:
-                top_ids.append(pid)
+        top_ids = [r["place_id"] for r in ranked[:3] if r.get("place_id")]
 
         record = Recommendation(
             user_input=user_input,
             location=location,
             category=category,
-            top_place_ids=",".join(top_ids),
-            recommendation_json=ranked,
+            top_place_ids=top_ids,
+            recommendation_json=dump_recommendation_json(ranked),
         )
 
         db.add(record)
         db.commit()
-        print("[insert_recommendation_record] 已寫入 Recommendation 紀錄")
+        log.debug("[insert_recommendation_record] 已寫入 Recommendation 紀錄")
     except Exception as e:
         db.rollback()
-        print("[insert_recommendation_record] 資料庫錯誤：", e)
+        log.error("[insert_recommendation_record] 資料庫錯誤：%s", e)
     finally:
         db.close()
 # ============================================================
 # NLP 解析函式
 # ============================================================
 
-def detect_non_food_intent(text: str) -> bool:
-    """
-    判斷使用者輸入是否與餐廳推薦完全無關
-    
-    使用 Gemini LLM 進行意圖識別，區分以下情況：
-    - 相關：提到吃飯、餐廳、食物、地點、料理類型等
-    - 無關：打招呼、聊天、情緒表達、無關問題
-    
-    參數：
-        text: 使用者的輸入文字
-        
-    返回：
-        bool: True 表示無關，False 表示相關
-        
-    設計目的：
-    - 過濾無效請求，提升系統效率
-    - 引導使用者提供正確的輸入格式
-    - 改善使用者體驗
-    
-    錯誤處理：
-    - API 呼叫失敗時預設為 False（假設相關），避免誤判
+# parse_user_input 的 structured output schema：
+# 交給 Gemini 在解碼階段直接套用，輸出保證是合法 JSON
+_PARSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "on_topic": {"type": "boolean"},
+        "location": {"type": "string", "nullable": True},
+        "category": {"type": "string", "nullable": True},
+        "preferences": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["on_topic", "preferences"],
+}
+
+# 五條強偏好 pattern 併成一條 alternation，named group 即標準化代碼：
+# 每個偏好只掃一次 regex（命中時用 m.lastgroup 取 tag），不必逐條嘗試
+_STRONG_PREF_RE = re.compile(
+    r"(?P<no_beef>(?:不吃|不能).*牛)"
+    r"|(?P<no_spicy>(?:不吃|不能).*辣)"
+    r"|(?P<vegetarian>素食|吃素|vegan|vegetarian)"
+    r"|(?P<halal>清真|halal)"
+    r"|(?P<no_pork>(?:不吃|不能).*豬)"
+)
+
+# 常見招呼 / 純情緒輸入的快篩：命中就直接回覆，完全不打 Gemini
+_GREETING_RE = re.compile(
+    r"^\s*(嗨+|哈囉+|哈啰+|你好+|您好|安安|早安|午安|晚安|hi+|hello+|hey+|"
+    r"哈+|呵+|嘻+|qq+|嗚+|哭哭|無聊|好無聊|你是誰|你在嗎)\s*[!！~～。.?？]*\s*$",
+    re.IGNORECASE,
+)
+
+# place_search_node 名稱過濾用的關鍵字表：
+# (keywords, require)；require=True 表示名稱必須含任一關鍵字才保留（素食/清真），
+# False 表示含任一關鍵字就剔除（不吃牛/辣/豬）。
+# 全是固定字串比對，用 `in` 的 C 層子字串掃描即可，不需要 regex 引擎
+_STRONG_NAME_FILTERS = {
+    "no_beef": (("牛",), False),
+    "no_spicy": (("辣",), False),
+    "vegetarian": (("素食", "蔬食", "vegan", "vegetarian"), True),
+    "halal": (("清真", "halal"), True),
+    "no_pork": (("豬",), False),
+}
+
+# 意圖分類的本地原型例句：用 analyze_reviews 同一顆 sentence encoder
+# 算出「找餐廳」與「與吃無關」兩類的中心向量，大多數輸入在本地就能判定
+_FOOD_EXAMPLES = [
+    "我想吃火鍋", "附近有什麼好吃的餐廳", "推薦台北的日式料理",
+    "想找安靜的咖啡廳", "晚餐吃什麼好", "信義區有燒肉店嗎",
+    "想吃辣的", "有沒有適合聚餐的餐廳", "我想喝珍奶", "找一間平價義大利麵",
+    "宵夜想吃鹹酥雞", "推薦約會餐廳", "素食餐廳哪裡有", "想吃甜點",
+    "高雄的海鮮餐廳",
+]
+_NONFOOD_EXAMPLES = [
+    "嗨", "你好", "早安", "你是誰", "你在嗎", "今天天氣真好",
+    "我好累", "好無聊喔", "哈哈哈", "哭哭", "幫我寫作業",
+    "現在幾點", "你叫什麼名字", "我心情不好", "明天會下雨嗎",
+]
+# 兩類相似度差距小於此值時視為模稜兩可，交給 parse 回傳的 on_topic 判斷
+_INTENT_MARGIN = 0.05
+_INTENT_CENTROIDS = None  # None=尚未計算, False=encoder 不可用
+
+# 確認 / 取消 / 無偏好的固定詞彙：這類輸入用 set 查表就能分流，
+# 不必付 parse_user_input 的 LLM 往返
+_CONFIRM_TOKENS = frozenset(["是", "yes", "ok", "好", "對", "確定", "嗯", "恩"])
+_CANCEL_TOKENS = frozenset(["否", "不要", "no", "取消", "不是"])
+_NO_PREF_TOKENS = frozenset([
+    "沒有", "没有", "無", "无", "no", "none",
+    "開始搜尋", "开始搜寻", "搜尋", "搜寻", "開始", "开始",
+])
+
+# 評論太少或理由生成失敗時的通用推薦理由
+_DEFAULT_REASON = "系統暫時無法提供詳細理由，建議可先參考整體評價與評論內容。"
+
+# 評論數低於此值就不值得跑 NLP 模型（分數沒有參考價值）
+_MIN_REVIEWS_FOR_NLP = 3
+
+# 背景資料庫寫入池：評論與推薦紀錄的寫入不影響回覆內容，
+# 丟到背景執行，使用者請求不用等 fsync 與 embedding 編碼完成。
+# 餐廳基本資料的 UPSERT 仍走同步路徑（後續的評論寫入依賴該列存在）
+_DB_WRITER = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="db-writer"
+)
+# 行程結束時讓佇列中的寫入跑完，避免掉資料
+atexit.register(_DB_WRITER.shutdown)
+
+# 推測式 LLM 呼叫池：parse_input_node 把 parse_user_input 先丟進來跑，
+# 與本地意圖判斷（detect_non_food_intent_local）重疊等待；
+# 本地判定無關時直接取消，省下整趟 Gemini 往返
+_LLM_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="llm-spec"
+)
+atexit.register(_LLM_POOL.shutdown)
+
+# Google Places 搜尋結果的短 TTL 快取：{(location, category): (時間戳, 結果)}
+# 使用者常在幾分鐘內重送或微調同一組條件；空結果也照樣快取（negative cache），
+# 重複的無效查詢不用再付一次 API 往返
+_PLACES_CACHE: Dict[Any, Any] = {}
+_PLACES_CACHE_TTL = 300  # 秒
+_PLACES_CACHE_MAX = 512
+
+# 同條件搜尋的 singleflight：兩個連線同時查「信義區 火鍋」時，
+# 後到者等先到者的結果，不重複打整串 Geocode + Nearby + Details
+_SEARCH_INFLIGHT: Dict[Any, concurrent.futures.Future] = {}
+_SEARCH_INFLIGHT_LOCK = threading.Lock()
+
+
+def _search_restaurants_coalesced(location: str, category: str) -> List[Dict[str, Any]]:
+    """search_restaurants 的請求合流包裝
+
+    TTL 快取只擋得住先後到達的重複查詢；這裡再擋同時在途的：
+    同 key 的第一個呼叫真正去搜，其餘呼叫共用同一個 Future 的結果。
     """
-    prompt = f"""
-    判斷以下訊息是否與尋找餐廳、吃飯、食物、地點、餐廳種類相關？
-    僅回答 yes 或 no。
+    key = (location, category)
+    with _SEARCH_INFLIGHT_LOCK:
+        fut = _SEARCH_INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = concurrent.futures.Future()
+            _SEARCH_INFLIGHT[key] = fut
+    if not owner:
+        # 跟隨者拿淺拷貝：兩條對話各自往 dict 掛欄位時不會互相污染
+        return [dict(r) for r in fut.result()]
+    try:
+        result = search_restaurants(location, category)
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _SEARCH_INFLIGHT_LOCK:
+            _SEARCH_INFLIGHT.pop(key, None)
+
+# LLM 回應快取：同樣的使用者輸入不重打 Gemini（每次省數百 ms 的往返）
+# 只快取成功的結果，失敗不進快取，之後重試仍會真的呼叫
+_INTENT_CACHE: Dict[str, bool] = {}
+_PARSE_CACHE: Dict[str, Dict[str, Any]] = {}
+_LLM_CACHE_MAX = 2048
+
+
+def _normalize_for_cache(text: str) -> str:
+    """正規化輸入當快取 key：NFKC + 去空白 + 小寫，讓同義寫法共用快取"""
+    return unicodedata.normalize("NFKC", (text or "")).replace(" ", "").strip().lower()
+
+def _intent_centroids():
+    """取得（必要時計算）兩類意圖的中心向量，encoder 不可用時回傳 False"""
+    global _INTENT_CENTROIDS
+    if _INTENT_CENTROIDS is None:
+        food = encode_texts(_FOOD_EXAMPLES)
+        nonfood = encode_texts(_NONFOOD_EXAMPLES)
+        if food is None or nonfood is None:
+            _INTENT_CENTROIDS = False
+        else:
+            def _centroid(m):
+                m = np.asarray(m, dtype=np.float32)
+                m /= np.linalg.norm(m, axis=1, keepdims=True) + 1e-12
+                c = m.mean(axis=0)
+                return c / (np.linalg.norm(c) + 1e-12)
+            _INTENT_CENTROIDS = (_centroid(food), _centroid(nonfood))
+    return _INTENT_CENTROIDS
 
-    使用者訊息: 「{text}」
 
-    若屬於下列類型則回答 yes（表示無關）：
-    - 打招呼 (嗨、哈囉、你好)
-    - 聊天或生活狀況 (我好累、今天天氣好)
-    - 心情分享 (好無聊、肚子痛)
-    - 問候 (你在嗎、你是誰)
-    - 與食物無關的問題 (你叫什麼名字、幾點了)
-    - 只有情緒表達 (哈哈哈、哭哭、QQ)
+def detect_non_food_intent_local(text: str) -> Optional[bool]:
+    """本地快速版意圖判斷：查快取 + 原型中心分類，不打 LLM
 
-    若訊息提到：吃東西、找餐廳、想吃什麼、地點、餐廳類型等 → 回答 no。
-    僅輸出 yes 或 no。
+    返回：
+        True / False: 本地能確定無關 / 相關
+        None: 模稜兩可，呼叫端自行決定 fallback 方式
     """
-    try:
-        result = call_gemini(prompt).strip().lower()
-        return result.startswith("yes")
-    except Exception:
-        return False
+    cache_key = _normalize_for_cache(text)
+    if cache_key in _INTENT_CACHE:
+        return _INTENT_CACHE[cache_key]
+
+    centroids = _intent_centroids()
+    if centroids:
+        vec = encode_texts([text])
+        if vec is not None:
+            v = np.asarray(vec[0], dtype=np.float32)
+            v /= np.linalg.norm(v) + 1e-12
+            sim_food = float(v @ centroids[0])
+            sim_nonfood = float(v @ centroids[1])
+            if abs(sim_food - sim_nonfood) >= _INTENT_MARGIN:
+                answer = sim_nonfood > sim_food
+                if len(_INTENT_CACHE) < _LLM_CACHE_MAX:
+                    _INTENT_CACHE[cache_key] = answer
+                return answer
+            log.debug(
+                "[detect_non_food_intent_local] 相似度差距 %.3f 過小，無法本地判定",
+                abs(sim_food - sim_nonfood),
+            )
+    return None
 
 
 def parse_user_input(user_input: str) -> Optional[Dict[str, Any]]:
@@ -337,10 +573,14 @@ def parse_user_input(user_input: str) -> Optional[Dict[str, Any]]:
         
     輸出格式：
     {
+        "on_topic": bool,
         "location": str | None,
         "category": str | None,
         "preferences": List[str]
     }
+
+    on_topic 是融合進同一次呼叫的主題判斷：本地意圖分類模稜兩可時
+    直接用這個欄位，不必再打第二次 Gemini
     
     處理流程：
     1. 使用 LLM 將自然語言轉換為結構化 JSON
@@ -353,40 +593,40 @@ def parse_user_input(user_input: str) -> Optional[Dict[str, Any]]:
     - JSON 解析失敗時返回 None
     - 容錯處理不完整的回應
     """
+    cache_key = _normalize_for_cache(user_input)
+    cached = _PARSE_CACHE.get(cache_key)
+    if cached is not None:
+        # 回傳淺拷貝，避免呼叫端改動污染快取
+        return {**cached, "preferences": list(cached.get("preferences", []))}
+
     prompt = f"""
     將以下使用者需求整理成 JSON：
     「{user_input}」
     
     回傳格式：
     {{
+      "on_topic": true 或 false,
       "location": "地點（如果沒提到則為 null）",
       "category": "餐廳類型（如：火鍋、壽司、燒肉，沒提到則為 null）",
       "preferences": ["偏好1", "偏好2"]
     }}
-    
+
     注意：
+    - on_topic：訊息與找餐廳、吃飯、食物、地點、餐廳類型相關為 true；
+      打招呼、聊天、心情分享、與食物無關的問題為 false
     - 如果使用者沒有明確提到地點，location 必須是 null
     - 如果使用者沒有明確提到餐廳類型，category 必須是 null
     - 如果沒有特別偏好，preferences 可以是空陣列 []
-    
+
     僅輸出 JSON，不要其他文字。
     """
     try:
-        raw = call_gemini(prompt).strip()
-        print("[parse_user_input] Gemini 原始回傳：", raw)
-
-        # 移除 markdown 標記
-        raw = re.sub(r"```(?:json)?(.*?)```", r"\1", raw, flags=re.DOTALL).strip()
-
-        # 提取 JSON
-        start_idx = raw.find("{")
-        end_idx = raw.rfind("}")
-        if start_idx == -1 or end_idx == -1:
-            raise ValueError("找不到有效的 JSON 區塊")
-
-        json_str = raw[start_idx: end_idx + 1]
-        data = json.loads(json_str)
-        print("[parse_user_input] 解析後 JSON：", data)
+        # structured output：模型在解碼階段就被限制成合法 JSON，
+        # 不再需要剝 markdown 圍欄、找大括號的防禦式解析
+        data = call_gemini_json(prompt, schema=_PARSE_SCHEMA)
+        if not isinstance(data, dict):
+            raise ValueError("Gemini 未回傳 JSON 物件")
+        log.debug("[parse_user_input] 解析後 JSON：%s", data)
 
         # 確保 preferences 是 list
         if isinstance(data.get("preferences"), str):
@@ -394,9 +634,12 @@ def parse_user_input(user_input: str) -> Optional[Dict[str, Any]]:
         if not data.get("preferences"):
             data["preferences"] = []
 
+        if len(_PARSE_CACHE) < _LLM_CACHE_MAX:
+            _PARSE_CACHE[cache_key] = {**data, "preferences": list(data["preferences"])}
+
         return data
     except Exception as e:
-        print("[parse_user_input] 解析失敗：", e)
+        log.error("[parse_user_input] 解析失敗：%s", e)
         return None
 
 
@@ -427,27 +670,28 @@ def classify_preferences(prefs: List[str]) -> Dict[str, List[str]]:
     - 使用正則表達式進行彈性匹配
     - 支援多種表達方式（不吃/不能）
     - 標準化偏好代碼便於後續處理
+    - 純函式：同一組偏好在不同節點重複呼叫時直接取 lru_cache 結果
     """
+    strong, weak = _classify_preferences_cached(tuple(prefs or []))
+    # 回傳新的 list，呼叫端改動不會污染快取
+    return {"strong": list(strong), "weak": list(weak)}
+
+
+@functools.lru_cache(maxsize=1024)
+def _classify_preferences_cached(prefs: tuple):
     strong = []
     weak = []
 
     for p in prefs:
         txt = p.lower()
 
-        if re.search(r"(不吃|不能).*牛", txt):
-            strong.append("no_beef")
-        elif re.search(r"(不吃|不能).*辣", txt):
-            strong.append("no_spicy")
-        elif re.search(r"(素食|吃素|vegan|vegetarian)", txt):
-            strong.append("vegetarian")
-        elif re.search(r"(清真|halal)", txt):
-            strong.append("halal")
-        elif re.search(r"(不吃|不能).*豬", txt):
-            strong.append("no_pork")
+        m = _STRONG_PREF_RE.search(txt)
+        if m:
+            strong.append(m.lastgroup)
         else:
             weak.append(txt)
 
-    return {"strong": strong, "weak": weak}
+    return tuple(strong), tuple(weak)
 
 
 # ============================================================
@@ -480,9 +724,37 @@ class RecommendAgent:
     def __init__(self):
         self.max_reviews = 80
         self.cache_days = 30
+        # 爬取併發數可由環境變數調整（部署機網路/記憶體條件不同）
+        self.max_fetch_workers = int(os.getenv("FETCH_WORKERS", 12))
         self.weights = {"match_score": 0.7, "positive_rate": 0.2, "rating": 0.1}
-
-    def fetch_single(self, restaurant: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # 行程內評論快取：{place_id: (當天日期, reviews)}
+        # 同一個服務行程裡重複查同一間餐廳時，連資料庫都不用再讀
+        self._review_mem_cache: Dict[str, Any] = {}
+        # 常駐爬取執行緒池：agent 是全域單例，池跟著行程活，
+        # 不必每個批次呼叫都重新生執行緒再收掉
+        self._fetch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_fetch_workers
+        )
+        # 爬取走獨立的小池（SCRAPE_WORKERS，預設 4）：瀏覽器吃記憶體，
+        # 而且每條爬過的執行緒會在 threading.local 養一顆常駐 Chromium，
+        # 若直接在 FETCH_WORKERS 寬的池裡爬，閒置瀏覽器數會隨時間逼近
+        # 池寬；專用池讓併發上限與常駐瀏覽器數都等於池寬
+        self.max_scrape_workers = int(
+            os.getenv("SCRAPE_WORKERS", min(4, self.max_fetch_workers))
+        )
+        self._scrape_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_scrape_workers, thread_name_prefix="scrape"
+        )
+        # 分析結果快取：{(評論內容雜湊, weak 偏好): 分析結果}
+        # 以內容定址——評論集沒變、偏好相同時直接重用，不會有過期問題
+        self._analysis_cache: Dict[Any, Dict[str, Any]] = {}
+        self._analysis_cache_max = 512
+
+    def fetch_single(
+        self,
+        restaurant: Dict[str, Any],
+        skip_upsert: bool = False,
+    ) -> Optional[Dict[str, Any]]:
         """
         爬取單一餐廳的評論資料
         
@@ -495,7 +767,9 @@ class RecommendAgent:
         
         參數：
             restaurant: 餐廳資訊字典
-            
+            skip_upsert: 呼叫端（如 place_search_node）已寫入過餐廳
+                         基本資料時設 True，略過重複的 UPSERT
+
         返回：
             Dict: {"restaurant": {...}, "reviews": [...]}
             None: 處理失敗時返回
@@ -507,36 +781,59 @@ class RecommendAgent:
         """
         name = restaurant.get("name")
         place_id = restaurant.get("place_id")
-        print(f"[fetch_single] 應處理餐廳：{name} ({place_id})")
+        log.debug("[fetch_single] 應處理餐廳：%s (%s)", name, place_id)
 
         if not name or not place_id:
-            print("[fetch_single] 缺少名稱或 place_id，略過")
+            log.debug("[fetch_single] 缺少名稱或 place_id，略過")
             return None
 
-        upsert_restaurant_from_dict(restaurant)
+        # 第一層：行程內記憶體快取（當天有效），完全不碰資料庫
+        today = datetime.date.today()
+        memo = self._review_mem_cache.get(place_id)
+        if memo and memo[0] == today:
+            log.debug("[fetch_single] 使用記憶體快取：%s，評論數：%s", name, len(memo[1]))
+            return {"restaurant": restaurant, "reviews": memo[1]}
 
-        cache = get_cached_reviews_if_fresh(place_id, self.cache_days)
+        # 餐廳 UPSERT（視 skip_upsert 而定）與快取檢查合併在同一個 session
+        cache = sync_restaurant_and_get_fresh_reviews(
+            restaurant, self.cache_days, skip_upsert=skip_upsert
+        )
         if cache:
-            print(f"[fetch_single] 使用資料庫快取：{name}，評論數：{len(cache)}")
+            log.debug("[fetch_single] 使用資料庫快取：%s，評論數：%s", name, len(cache))
+            self._review_mem_cache[place_id] = (today, cache)
             return {"restaurant": restaurant, "reviews": cache}
 
-        print(f"[fetch_single] 無可用快取，開始爬取：{name}")
-        reviews = get_all_reviews(name, place_id, max_reviews=self.max_reviews) or []
-        print(f"[fetch_single] {name} 實際抓到評論數：{len(reviews)}")
+        log.debug("[fetch_single] 無可用快取，開始爬取：%s", name)
+        # 真正的爬取轉進爬取專用池執行（fetch 池的執行緒在這裡等結果），
+        # 常駐瀏覽器只會長在專用池的那幾條執行緒上
+        reviews = self._scrape_pool.submit(
+            get_all_reviews, name, place_id, max_reviews=self.max_reviews
+        ).result() or []
+        log.debug("[fetch_single] %s 實際抓到評論數：%s", name, len(reviews))
 
         if reviews:
-            replace_reviews_in_db(place_id, reviews)
+            # 寫 DB（含 embedding 編碼）丟背景池，回覆流程不等寫入完成；
+            # 本回合的分析用的是記憶體中的這份 reviews，不受影響
+            _DB_WRITER.submit(
+                replace_reviews_in_db, place_id, reviews,
+                restaurant.get("user_ratings_total"),
+            )
+            self._review_mem_cache[place_id] = (today, reviews)
         else:
-            print(f"[fetch_single] {name} 沒有成功取得評論，資料庫評論維持不變")
+            log.debug("[fetch_single] %s 沒有成功取得評論，資料庫評論維持不變", name)
 
         return {"restaurant": restaurant, "reviews": reviews}
 
-    def fetch_reviews_batch(self, restaurants: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def fetch_reviews_batch(
+        self,
+        restaurants: List[Dict[str, Any]],
+        weak: Optional[List[str]] = None,
+    ) -> List[Dict[str, Any]]:
         """
         批次並行爬取多間餐廳的評論
         
         使用執行緒池實現並行處理，提升整體效能：
-        - 最多 3 個並行執行緒（避免過度佔用資源）
+        - 常駐池併發數由 FETCH_WORKERS 環境變數控制（預設 12）
         - 使用 Future 機制處理非同步結果
         - 個別餐廳失敗不影響其他餐廳
         
@@ -551,22 +848,136 @@ class RecommendAgent:
         - 執行緒池重用減少建立開銷
         - 容錯機制確保部分失敗不影響整體
         """
-        print(f"[fetch_reviews_batch] 準備處理餐廳數量：{len(restaurants)}")
+        log.debug("[fetch_reviews_batch] 準備處理餐廳數量：%s", len(restaurants))
         results: List[Dict[str, Any]] = []
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as exe:
-            futures = [exe.submit(self.fetch_single, r) for r in restaurants]
-            for f in concurrent.futures.as_completed(futures):
-                try:
-                    res = f.result()
-                    if res:
-                        results.append(res)
-                except Exception as e:
-                    print("[fetch_reviews_batch] future 發生錯誤：", e)
+        # 若呼叫端給了弱偏好，爬完一間就先把 NLP 分析丟進分析池
+        # （流水線：不必等最慢的一間爬完才開始算 embedding）
+        analysis_pool = None
+        if weak is not None:
+            analysis_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+        def _collect(res: Dict[str, Any]) -> None:
+            # 評論太少的餐廳不進 NLP（analyze_results 會直接給零分）
+            if analysis_pool is not None and len(res["reviews"]) >= _MIN_REVIEWS_FOR_NLP:
+                res["analysis_future"] = analysis_pool.submit(
+                    self._nlp_scores, res["reviews"], weak
+                )
+            results.append(res)
+
+        # 快取分流：記憶體快取 + 一條批次查詢先把命中的撈出來，
+        # worker 執行緒只處理真正要爬的 miss（原本每間各開 session 查一次）
+        today = datetime.date.today()
+        to_lookup: List[Dict[str, Any]] = []
+        to_fetch: List[Dict[str, Any]] = []
+        for r in restaurants:
+            place_id = r.get("place_id")
+            memo = self._review_mem_cache.get(place_id) if place_id else None
+            if memo and memo[0] == today:
+                _collect({"restaurant": r, "reviews": memo[1]})
+            elif place_id and r.get("name"):
+                to_lookup.append(r)
+            # 缺 name / place_id 的項目直接略過（同 fetch_single 的檢查）
+
+        cached_map = batch_load_fresh_reviews(
+            [r["place_id"] for r in to_lookup],
+            self.cache_days,
+            totals={
+                r["place_id"]: r.get("user_ratings_total") for r in to_lookup
+            },
+        )
+        for r in to_lookup:
+            cached = cached_map.get(r["place_id"])
+            if cached:
+                self._review_mem_cache[r["place_id"]] = (today, cached)
+                _collect({"restaurant": r, "reviews": cached})
+            else:
+                to_fetch.append(r)
+
+        log.debug(
+            "[fetch_reviews_batch] 快取命中 %s 間，需爬取 %s 間",
+            len(results), len(to_fetch),
+        )
 
-        print(f"[fetch_reviews_batch] 成功取得評論的餐廳數量：{len(results)}")
+        # 爬蟲走 Playwright（瀏覽器 I/O），執行緒在等待網頁時會釋放 GIL，
+        # 所以用常駐池直接放大併發，不需要額外的節流 sleep；
+        # 真正開瀏覽器的數量由 fetch_single 轉送的爬取專用池把關
+        # place_search_node 進到這裡之前已整批 UPSERT 餐廳，免去 2N 次重複寫入
+        futures = [
+            self._fetch_pool.submit(self.fetch_single, r, skip_upsert=True)
+            for r in to_fetch
+        ]
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                res = f.result()
+                if res:
+                    _collect(res)
+            except Exception as e:
+                log.error("[fetch_reviews_batch] future 發生錯誤：%s", e)
+
+        if analysis_pool is not None:
+            # 已提交的分析繼續在背景跑，analyze_results 取 future 結果時才等
+            analysis_pool.shutdown(wait=False)
+
+        log.debug("[fetch_reviews_batch] 成功取得評論的餐廳數量：%s", len(results))
         return results
 
+    def _prep_reviews(self, reviews: List[Dict[str, Any]]):
+        """去重並收集 DB 快取向量，回傳 (unique_reviews, embeddings | None)"""
+        # 先去除重複評論文字（垃圾灌水、重抓、雙語複本），
+        # 重複的文字不必重複進 embedding 模型
+        seen: set = set()
+        unique = []
+        for rv in reviews or []:
+            key = (rv.get("text") or "").strip()
+            if key and key not in seen:
+                seen.add(key)
+                unique.append(rv)
+        if len(unique) < len(reviews or []):
+            log.debug(
+                "[analyze_results] 去重後評論 %s -> %s 筆",
+                len(reviews), len(unique),
+            )
+
+        # 快取來的評論帶有存好的句向量：全員到齊才組矩陣，
+        # 缺任何一筆就整批交回 analyze_reviews 重新編碼
+        embeddings = None
+        blobs = [rv.get("embedding") for rv in unique]
+        if unique and all(blobs):
+            embeddings = np.vstack([
+                np.frombuffer(b, dtype=np.float16).reshape(1, EMBED_DIM)
+                for b in blobs
+            ])
+        return unique, embeddings
+
+    def _analysis_key(self, unique: List[Dict[str, Any]], weak: List[str]):
+        """以評論內容 + 偏好組出內容定址的快取 key"""
+        digest = hashlib.blake2b(
+            "\n".join(sorted(rv.get("text") or "" for rv in unique)).encode("utf-8"),
+            digest_size=16,
+        ).digest()
+        return digest, tuple(weak or [])
+
+    def _nlp_scores(self, reviews: List[Dict[str, Any]], weak: List[str]) -> Dict[str, Any]:
+        """跑單間餐廳的 NLP 分析，失敗時回傳預設分數"""
+        try:
+            unique, embeddings = self._prep_reviews(reviews)
+            key = self._analysis_key(unique, weak)
+            cached = self._analysis_cache.get(key)
+            if cached is not None:
+                return dict(cached)
+            res = analyze_reviews(unique, weak, embeddings=embeddings)
+            if len(self._analysis_cache) < self._analysis_cache_max:
+                self._analysis_cache[key] = dict(res)
+            log.debug(
+                "[analyze_results] NLP 結果：match=%s, positive_rate=%s",
+                res.get("match_score"), res.get("positive_rate"),
+            )
+            return res
+        except Exception as e:
+            log.error("[analyze_results] analyze_reviews 發生錯誤：%s", e)
+            return {"summary": "", "match_score": 0.0, "positive_rate": 0.0}
+
     def analyze_results(self, review_batches: List[Dict[str, Any]], prefs: Dict[str, List[str]]) -> List[Dict[str, Any]]:
         """
         分析所有餐廳的評論並計算匹配度
@@ -598,44 +1009,125 @@ class RecommendAgent:
         - NLP 失敗：使用預設分數（0.0）
         - 理由生成失敗：提供通用訊息
         """
-        print("[analyze_results] 進來的餐廳數量：", len(review_batches))
-        print("[analyze_results] 使用者偏好（含 strong/weak）：", prefs)
+        log.debug("[analyze_results] 進來的餐廳數量：%s", len(review_batches))
+        log.debug("[analyze_results] 使用者偏好（含 strong/weak）：%s", prefs)
 
         weak = prefs.get("weak", [])
 
-        output: List[Dict[str, Any]] = []
-        for rb in review_batches:
-            r = rb["restaurant"]
-            reviews = rb["reviews"]
-            print(f"[analyze_results] 處理餐廳：{r.get('name')}，評論數：{len(reviews)}")
-
-            try:
-                res = analyze_reviews(reviews, weak)
-                print(
-                    f"[analyze_results] NLP 結果：match={res.get('match_score')}, "
-                    f"positive_rate={res.get('positive_rate')}"
-                )
-            except Exception as e:
-                print("[analyze_results] analyze_reviews 發生錯誤：", e)
-                res = {"summary": "", "match_score": 0.0, "positive_rate": 0.0}
+        # 流水線模式：fetch_reviews_batch 已在爬完當下就開始分析，
+        # 這裡只收割 future；沒有 future 的餐廳收集起來整批送模型，
+        # encoder / sentiment 各只前向一次，不隨餐廳數線性增加
+        scores: List[Optional[Dict[str, Any]]] = [None] * len(review_batches)
+        pending: List[int] = []
+        for idx, rb in enumerate(review_batches):
+            future = rb.pop("analysis_future", None)
+            # 工作迴避：評論太少時模型分數沒有參考價值，直接給零分，
+            # 也不讓這些餐廳進批次前向去浪費 padding
+            if future is None and len(rb.get("reviews") or []) < _MIN_REVIEWS_FOR_NLP:
+                scores[idx] = {"summary": "", "match_score": 0.0, "positive_rate": 0.0}
+                continue
+            if future is not None:
+                try:
+                    scores[idx] = future.result()
+                except Exception as e:
+                    log.error("[analyze_results] 分析 future 發生錯誤：%s", e)
+                    scores[idx] = {"summary": "", "match_score": 0.0, "positive_rate": 0.0}
+            else:
+                pending.append(idx)
 
+        if pending:
             try:
-                reason_text = generate_reason(r["name"], res.get("summary", ""), weak)
+                # 內容定址快取先擋一層：評論集沒變、偏好相同的餐廳直接重用
+                to_batch = []
+                for idx in pending:
+                    unique, emb = self._prep_reviews(review_batches[idx]["reviews"])
+                    key = self._analysis_key(unique, weak)
+                    cached = self._analysis_cache.get(key)
+                    if cached is not None:
+                        scores[idx] = dict(cached)
+                    else:
+                        to_batch.append((idx, unique, emb, key))
+
+                if to_batch:
+                    batch_res = analyze_reviews_batch(
+                        [unique for _, unique, _, _ in to_batch],
+                        weak,
+                        [emb for _, _, emb, _ in to_batch],
+                    )
+                    for (idx, _, _, key), res in zip(to_batch, batch_res):
+                        scores[idx] = res
+                        if len(self._analysis_cache) < self._analysis_cache_max:
+                            self._analysis_cache[key] = dict(res)
             except Exception as e:
-                print("[analyze_results] generate_reason 發生錯誤：", e)
-                reason_text = "系統暫時無法提供詳細理由，建議可先參考整體評價與評論內容。"
-
-            output.append({
-                **r,
+                log.error("[analyze_results] analyze_reviews_batch 發生錯誤：%s", e)
+                for idx in pending:
+                    if scores[idx] is None:
+                        scores[idx] = self._nlp_scores(review_batches[idx]["reviews"], weak)
+
+        output = [
+            {
+                **rb["restaurant"],
                 "summary": res.get("summary", ""),
                 "match_score": float(res.get("match_score", 0) or 0.0),
                 "positive_rate": float(res.get("positive_rate", 0) or 0.0),
-                "reason": reason_text,
-            })
+            }
+            for rb, res in zip(review_batches, scores)
+        ]
+
+        self._attach_reasons(output, weak)
 
-        print("[analyze_results] 最終輸出餐廳數量：", len(output))
+        log.debug("[analyze_results] 最終輸出餐廳數量：%s", len(output))
         return output
 
+    def _attach_reasons(self, restaurants: List[Dict[str, Any]], weak: List[str]) -> None:
+        """
+        為分析結果補上推薦理由：
+        - 先用一次 Gemini 批次呼叫生成所有餐廳的理由（N 次往返 → 1 次）
+        - 批次結果缺漏的餐廳才退回逐間 generate_reason
+        """
+        if not restaurants:
+            return
+
+        # 沒有摘要的餐廳（評論太少或分析失敗）直接用通用理由，
+        # 不浪費 LLM 呼叫在沒有素材的輸入上
+        with_summary = [r for r in restaurants if (r.get("summary") or "").strip()]
+        if not with_summary:
+            for r in restaurants:
+                r["reason"] = _DEFAULT_REASON
+            return
+
+        reasons = generate_reasons_batch(
+            [
+                {
+                    "place_id": r.get("place_id"),
+                    "name": r.get("name"),
+                    "summary": r.get("summary", ""),
+                }
+                for r in with_summary
+            ],
+            weak,
+        )
+
+        missing = [r for r in with_summary if not reasons.get(str(r.get("place_id")))]
+
+        # 批次缺漏的餐廳彼此獨立，逐間呼叫改成並行發出，
+        # 等待時間從 N × t_llm 縮成 ~max(t_llm)
+        def _fallback_reason(r: Dict[str, Any]) -> str:
+            try:
+                return generate_reason(r.get("name"), r.get("summary", ""), weak)
+            except Exception as e:
+                log.error("[analyze_results] generate_reason 發生錯誤：%s", e)
+                return _DEFAULT_REASON
+
+        if missing:
+            workers = min(4, len(missing))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as exe:
+                for r, reason_text in zip(missing, exe.map(_fallback_reason, missing)):
+                    reasons[str(r.get("place_id"))] = reason_text
+
+        for r in restaurants:
+            r["reason"] = reasons.get(str(r.get("place_id"))) or _DEFAULT_REASON
+
 
 # 全域單例實例
 agent = RecommendAgent()
@@ -674,7 +1166,17 @@ class RecommendState(BaseModel):
     - 不可變性：使用 Pydantic BaseModel 確保型別安全
     - 狀態隔離：每個請求獨立的狀態實例
     - 可追蹤性：保留完整的處理歷程
+
+    效能考量：
+    - LangGraph 每次節點轉移都會重建狀態；餐廳/評論欄位本來就是
+      opaque 的 dict，逐欄重新驗證沒有收益，關閉賦值驗證並放行任意型別
     """
+    model_config = ConfigDict(
+        validate_assignment=False,
+        arbitrary_types_allowed=True,
+        extra="allow",
+    )
+
     user_input: Optional[str] = None
     location: Optional[str] = None
     category: Optional[str] = None
@@ -728,33 +1230,63 @@ def parse_input_node(state: RecommendState) -> Dict[str, Any]:
     - 彈性的輸入格式
     """
     text = (state.user_input or "").strip()
-    print(f"[parse_input_node] 輸入：{text}")
+    log.debug("[parse_input_node] 輸入：%s", text)
     
     # 檢查是否在等待確認狀態
     if state.waiting_for_confirmation:
-        print("[parse_input_node] 偵測到等待確認狀態，轉到 confirm_response_node")
+        log.debug("[parse_input_node] 偵測到等待確認狀態，轉到 confirm_response_node")
         return {"next": "confirm_response_node"}
     
     # 檢查是否在等待偏好輸入狀態
     if state.waiting_for_preference:
-        print("[parse_input_node] 偵測到等待偏好狀態，轉到 preference_response_node")
+        log.debug("[parse_input_node] 偵測到等待偏好狀態，轉到 preference_response_node")
         return {"next": "preference_response_node"}
 
-    # 判斷是否完全無關
-    if detect_non_food_intent(text):
+    # 快篩：明顯的招呼 / 純情緒輸入直接回覆，不浪費一次 Gemini 往返
+    if not text or _GREETING_RE.match(text):
+        return {
+            "next": "end",
+            "message": "我只能幫你推薦餐廳喔！請告訴我想在哪裡吃什麼類型的餐廳～\n例如：「想在信義區吃火鍋」"
+        }
+
+    # 快篩：落單的確認/取消/無偏好詞（不在等待流程時出現）沒有可解析的內容，
+    # 查表直接引導，不進 LLM
+    low = text.lower()
+    if low in _CONFIRM_TOKENS or low in _CANCEL_TOKENS or low in _NO_PREF_TOKENS:
+        return {
+            "next": "end",
+            "message": "請告訴我想在哪裡吃什麼類型的餐廳喔～\n例如：「想在信義區吃火鍋」"
+        }
+
+    # 推測式並行：先把 parse_user_input 丟到背景跑，
+    # 與意圖判斷重疊等待；輸入被判定無關時結果直接丟棄
+    parse_future = _LLM_POOL.submit(parse_user_input, text)
+
+    # 判斷是否完全無關：本地分類能確定就立刻擋掉；
+    # 模稜兩可時不再額外打一次 Gemini，改看 parse 結果裡融合的
+    # on_topic 欄位（同一次呼叫順便判斷主題，LLM 往返從兩次降成一次）
+    local_non_food = detect_non_food_intent_local(text)
+    if local_non_food:
+        parse_future.cancel()
         return {
             "next": "end",
             "message": "我只能幫你推薦餐廳喔！請告訴我想在哪裡吃什麼類型的餐廳～\n例如：「想在信義區吃火鍋」"
         }
 
     # 解析輸入
-    data = parse_user_input(text)
+    data = parse_future.result()
     if not data:
         return {
             "next": "end",
             "message": "我不太懂你的意思，可以換個方式說嗎？\n例如：「想在信義區吃火鍋」"
         }
 
+    if local_non_food is None and data.get("on_topic") is False:
+        return {
+            "next": "end",
+            "message": "我只能幫你推薦餐廳喔！請告訴我想在哪裡吃什麼類型的餐廳～\n例如：「想在信義區吃火鍋」"
+        }
+
     new_location = data.get("location")
     new_category = data.get("category")
     new_preferences = data.get("preferences", [])
@@ -773,7 +1305,7 @@ def parse_input_node(state: RecommendState) -> Dict[str, Any]:
     current_location = updates.get("location") or state.location
     current_category = updates.get("category") or state.category
 
-    print(f"[parse_input_node] 目前狀態 - 地點:{current_location}, 類型:{current_category}")
+    log.debug("[parse_input_node] 目前狀態 - 地點:%s, 類型:%s", current_location, current_category)
 
     # 情況1：只有偏好（沒有地點也沒有類型）
     if not current_location and not current_category:
@@ -829,7 +1361,7 @@ def validate_location_node(state: RecommendState) -> Dict[str, Any]:
     - 保留類型和偏好資訊
     """
     loc = state.location
-    print(f"[validate_location_node] 驗證地點：{loc}")
+    log.debug("[validate_location_node] 驗證地點：%s", loc)
 
     if location_is_too_large(loc):
         return {
@@ -927,10 +1459,10 @@ def preference_response_node(state: RecommendState) -> Dict[str, Any]:
     - 不阻斷流程繼續執行
     """
     text = (state.user_input or "").strip().lower()
-    print(f"[preference_response_node] 收到偏好回應：{text}")
+    log.debug("[preference_response_node] 收到偏好回應：%s", text)
     
     # 使用者表示沒有偏好
-    if text in ["沒有", "没有", "無", "无", "no", "none", "開始搜尋", "开始搜寻", "搜尋", "搜寻", "開始", "开始"]:
+    if text in _NO_PREF_TOKENS:
         return {
             "next": "final_confirm_node",
             "waiting_for_preference": False
@@ -941,7 +1473,7 @@ def preference_response_node(state: RecommendState) -> Dict[str, Any]:
     
     if data and data.get("preferences"):
         prefs = classify_preferences(data.get("preferences", []))
-        print(f"[preference_response_node] 解析到偏好：{prefs}")
+        log.debug("[preference_response_node] 解析到偏好：%s", prefs)
         
         return {
             "next": "final_confirm_node",
@@ -1037,17 +1569,17 @@ def confirm_response_node(state: RecommendState) -> Dict[str, Any]:
     - 提供友善的退出機制
     """
     text = (state.user_input or "").strip().lower()
-    print(f"[confirm_response_node] 收到回應：{text}")
+    log.debug("[confirm_response_node] 收到回應：%s", text)
     
     # 確認要搜尋
-    if text in ["是", "yes", "ok", "好", "對", "確定", "嗯", "恩"]:
+    if text in _CONFIRM_TOKENS:
         return {
             "next": "place_search_node",
             "waiting_for_confirmation": False
         }
     
     # 取消搜尋
-    if text in ["否", "不要", "no", "取消", "不是"]:
+    if text in _CANCEL_TOKENS:
         return {
             "next": "end",
             "location": None,
@@ -1106,12 +1638,24 @@ def place_search_node(state: RecommendState) -> Dict[str, Any]:
     - 信任 Google Places API 的結果
     - 強偏好優先於評分和評論
     """
-    print("[place_search_node] location =", state.location, "category =", state.category)
+    log.debug("[place_search_node] location=%s category=%s", state.location, state.category)
     loc, cat = state.location, state.category
     
-    # Step 1: 直接搜尋
-    restaurants = search_restaurants(loc, cat)
-    print("[place_search_node] 搜尋到餐廳數量：", len(restaurants))
+    # Step 1: 直接搜尋（帶短 TTL 快取；強偏好過濾在快取之後才做，
+    # 所以 key 只需要 location + category）
+    cache_key = (loc, cat)
+    now = time.monotonic()
+    hit = _PLACES_CACHE.get(cache_key)
+    if hit is not None and now - hit[0] < _PLACES_CACHE_TTL:
+        # 回淺拷貝的 dict，下游節點掛欄位時不會改到快取本體
+        restaurants = [dict(r) for r in hit[1]]
+        log.debug("[place_search_node] 使用搜尋快取，餐廳數量：%s", len(restaurants))
+    else:
+        restaurants = _search_restaurants_coalesced(loc, cat)
+        if len(_PLACES_CACHE) >= _PLACES_CACHE_MAX:
+            _PLACES_CACHE.clear()
+        _PLACES_CACHE[cache_key] = (now, [dict(r) for r in restaurants])
+    log.debug("[place_search_node] 搜尋到餐廳數量：%s", len(restaurants))
 
     if not restaurants:
         return {"next": "end", "message": "找不到符合條件的餐廳，要不要換個地點或類型試試？"}
@@ -1120,33 +1664,33 @@ def place_search_node(state: RecommendState) -> Dict[str, Any]:
 
     # Step 2: 強偏好過濾
     strong = (state.preferences or {}).get("strong", [])
+    # 只挑出有啟用的過濾條件，每個餐廳名稱不必測完全部五種
+    active = [
+        _STRONG_NAME_FILTERS[tag] for tag in strong if tag in _STRONG_NAME_FILTERS
+    ]
     filtered = []
     for r in restaurants:
         name = (r.get("name") or "").lower()
-
-        if "no_beef" in strong and re.search(r"(牛|和牛|牛排)", name):
-            continue
-        if "no_spicy" in strong and re.search(r"(辣|麻辣|辣子|辣醬)", name):
-            continue
-        if "vegetarian" in strong and not re.search(r"(素食|蔬食|vegan|vegetarian)", name):
+        # 保留條件：排除型（require=False）不可命中，必要型（require=True）必須命中
+        if any(
+            any(kw in name for kw in keywords) != require
+            for keywords, require in active
+        ):
             continue
-        if "halal" in strong and not re.search(r"(清真|halal)", name):
-            continue
-        if "no_pork" in strong and re.search(r"(豬|豬肉)", name):
-            continue
-
         filtered.append(r)
 
     # 強偏好過濾後若為空，使用全部結果
     if not filtered:
         filtered = restaurants
 
-    # 資料庫寫入
-    for r in filtered:
-        upsert_restaurant_from_dict(r)
+    # 資料庫寫入：整批一個 transaction 的 UPSERT，而不是每間各開一個 session
+    try:
+        upsert_restaurants_bulk(filtered)
+    except Exception as e:
+        log.error("[place_search_node] 批次寫入餐廳失敗：%s", e)
 
     return {
-        "next": "review_fetch_node", 
+        "next": "review_fetch_node",
         "restaurants": filtered
     }
 
@@ -1179,17 +1723,19 @@ def review_fetch_node(state: RecommendState) -> Dict[str, Any]:
     - 確保使用者總能得到結果
     """
     restaurants = state.restaurants or []
-    print("[review_fetch_node] 餐廳數量：", len(restaurants))
+    log.debug("[review_fetch_node] 餐廳數量：%s", len(restaurants))
 
     if not restaurants:
         return {"next": "end", "message": "找不到相關餐廳"}
 
-    results = agent.fetch_reviews_batch(restaurants)
-    print("[review_fetch_node] fetch_reviews_batch 結果數量：", len(results))
+    # 把弱偏好一併傳入，讓每間餐廳爬完當下就開始 NLP 分析（與爬蟲重疊執行）
+    weak = (state.preferences or {}).get("weak", [])
+    results = agent.fetch_reviews_batch(restaurants, weak=weak)
+    log.debug("[review_fetch_node] fetch_reviews_batch 結果數量：%s", len(results))
 
     if not results:
         analyzed = restaurants
-        print("[review_fetch_node] 沒有成功取得評論，改用原始餐廳清單作 ranking")
+        log.debug("[review_fetch_node] 沒有成功取得評論，改用原始餐廳清單作 ranking")
         return {
             "next": "ranking_node",
             "analyzed": analyzed
@@ -1238,7 +1784,7 @@ def analysis_node(state: RecommendState) -> Dict[str, Any]:
     - 無評論資料：跳過分析直接排序
     - 分析失敗：使用預設值繼續流程
     """
-    print("[analysis_node] review_batches 數量：", len(state.review_batches or []))
+    log.debug("[analysis_node] review_batches 數量：%s", len(state.review_batches or []))
     if not state.review_batches:
         analyzed = state.analyzed or []
         return {"next": "ranking_node", "analyzed": analyzed}
@@ -1247,7 +1793,7 @@ def analysis_node(state: RecommendState) -> Dict[str, Any]:
         state.review_batches, 
         state.preferences or {"weak": [], "strong": []}
     )
-    print("[analysis_node] 分析後餐廳數量：", len(analyzed or []))
+    log.debug("[analysis_node] 分析後餐廳數量：%s", len(analyzed or []))
 
     return {
         "next": "ranking_node", 
@@ -1290,7 +1836,7 @@ def ranking_node(state: RecommendState) -> Dict[str, Any]:
     - 分數計算失敗：使用 0.0
     - 資料庫寫入失敗：不影響結果返回
     """
-    print("[ranking_node] analyzed 數量：", len(state.analyzed or []))
+    log.debug("[ranking_node] analyzed 數量：%s", len(state.analyzed or []))
 
     if not state.analyzed:
         return {
@@ -1299,48 +1845,77 @@ def ranking_node(state: RecommendState) -> Dict[str, Any]:
             "ranked": []
         }
 
+    # 只有一筆時沒有排序問題：跳過整段計分，推薦紀錄照樣在背景寫
+    if len(state.analyzed) == 1:
+        _DB_WRITER.submit(
+            insert_recommendation_record,
+            user_input=state.user_input,
+            location=state.location,
+            category=state.category,
+            ranked=state.analyzed,
+        )
+        return {
+            "next": "response_node",
+            "ranked": state.analyzed,
+            "recommendations": state.analyzed,
+        }
+
     ranked = state.analyzed
-    weights = {"match_score": 0.7, "positive_rate": 0.2, "rating": 0.1}
     weak = (state.preferences or {}).get("weak", [])
 
-    def score(r: Dict) -> float:
-        """
-        計算單一餐廳的綜合分數
-        
-        計算公式：
-        base_score = w1 × match + w2 × positive + w3 × (rating / 5)
-        final_score = base_score + bonus
-        
-        bonus 條件：
-        - 評論摘要包含弱偏好關鍵字：+0.05
-        
-        錯誤處理：
-        - 缺失欄位使用 0.0
-        - 計算異常返回 0.0
-        """
+    # 向量化計分：把三個指標疊成矩陣，用一次矩陣乘法算完所有餐廳
+    # base_score = 0.7 × match + 0.2 × positive + 0.1 × (rating / 5)
+    # bonus：評論摘要包含弱偏好關鍵字 +0.05
+    def _f(v) -> float:
         try:
-            base = (
-                weights["match_score"] * float(r.get("match_score") or 0.0)
-                + weights["positive_rate"] * float(r.get("positive_rate") or 0.0)
-                + weights["rating"] * (float(r.get("rating") or 0.0) / 5.0)
-            )
-            summary = (r.get("summary") or "").lower()
-            if any(w in summary for w in weak):
-                base += 0.05
-            return base
-        except Exception:
+            return float(v or 0.0)
+        except (TypeError, ValueError):
             return 0.0
 
-    ranked_sorted = sorted(ranked, key=score, reverse=True)
+    features = np.array(
+        [
+            [_f(r.get("match_score")), _f(r.get("positive_rate")), _f(r.get("rating")) / 5.0]
+            for r in ranked
+        ],
+        dtype=np.float32,
+    )
+    w = np.array([0.7, 0.2, 0.1], dtype=np.float32)
+    scores = features @ w
+
+    # 弱偏好關鍵字合成一條 alternation regex：每份摘要只掃一次，
+    # 不必對每個關鍵字各跑一輪 Python 層的子字串檢查
+    weak_pat = re.compile("|".join(map(re.escape, weak))) if weak else None
+    if weak_pat is not None:
+        bonus = np.array(
+            [
+                0.05 if weak_pat.search((r.get("summary") or "").lower()) else 0.0
+                for r in ranked
+            ],
+            dtype=np.float32,
+        )
+        scores += bonus
 
-    insert_recommendation_record(
+    order = np.argsort(-scores, kind="stable")
+    # 把算好的綜合分數掛回每筆結果，後續輸出與存檔直接取用，不再重算
+    for i in order:
+        ranked[i]["_score"] = round(float(scores[i]), 4)
+    ranked_sorted = [ranked[i] for i in order]
+
+    # 推薦紀錄純粹是事後分析用，寫入丟背景池，不擋回覆
+    _DB_WRITER.submit(
+        insert_recommendation_record,
         user_input=state.user_input,
         location=state.location,
         category=state.category,
         ranked=ranked_sorted,
     )
 
-    print("[ranking_node] 排序完成，TOP3 為：", [r.get("name") for r in ranked_sorted[:3]])
+    # 參數本身要先 materialize 一個 list，用 isEnabledFor 守住關閉時的成本
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(
+            "[ranking_node] 排序完成，TOP3 為：%s",
+            [(r.get("name"), r.get("_score")) for r in ranked_sorted[:3]],
+        )
     
     return {
         "next": "response_node",
@@ -1,11 +1,13 @@
 from langchain.tools import BaseTool
 from typing import Optional, Type
 from pydantic import BaseModel, Field
+import functools
 import os
-import torch
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
-from transformers import pipeline
+
+# torch / sentence_transformers / transformers 都在函式內才 import：
+# 這三個套件光 import 就要數秒，延到首次載入模型時一起付
 
 # ────────────────────────────────
 # 模型選擇
@@ -19,6 +21,9 @@ MODEL_DIR = os.path.join(os.path.dirname(__file__), "..", "models")
 def load_embedder():
     local_path = os.path.join(MODEL_DIR, "MiniLM-L12-v2")
     try:
+        # import 包進 try：套件缺失或壞掉時同樣走 fallback，不往外拋
+        from sentence_transformers import SentenceTransformer
+
         # 優先讀取本地快取
         if os.path.exists(local_path):
             return SentenceTransformer(local_path)
@@ -30,8 +35,11 @@ def load_embedder():
 
 def load_sentiment_analyzer():
     local_path = os.path.join(MODEL_DIR, "dianping-sentiment")
-    device = 0 if torch.cuda.is_available() else -1
     try:
+        import torch
+        from transformers import pipeline
+
+        device = 0 if torch.cuda.is_available() else -1
         if os.path.exists(local_path):
             return pipeline("sentiment-analysis", model=local_path, device=device)
         
@@ -47,8 +55,83 @@ def load_sentiment_analyzer():
         print(f"[WARN] 錯誤詳情：{e}")
         return None
 
-embedder = load_embedder()
-sentiment_analyzer = load_sentiment_analyzer()
+def _maybe_quantize(model):
+    """依部署環境降低模型精度：GPU 走 fp16、CPU 走 int8 動態量化
+
+    推論不需要 fp32 的精度餘裕，半精度/int8 把記憶體頻寬需求砍半、
+    吞吐約 2~4 倍。分別可用 EMBED_FP16=0 / EMBED_INT8=0 關閉；
+    轉換失敗一律沿用 fp32。
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        if os.getenv("EMBED_FP16", "1") != "1":
+            return model
+        try:
+            return model.half()
+        except Exception as e:
+            print(f"[WARN] fp16 轉換失敗，沿用 fp32：{e}")
+            return model
+    if os.getenv("EMBED_INT8", "1") != "1":
+        return model
+    try:
+        return torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    except Exception as e:
+        print(f"[WARN] int8 動態量化失敗，沿用 fp32：{e}")
+        return model
+
+
+# 模型延遲載入：import 時不碰模型，首次真正要編碼/分析才載入。
+# 伺服器冷啟動從「等兩顆模型載完」變成毫秒級，不跑分析的行程
+# 也不用付 MiniLM + sentiment 模型的數百 MB 記憶體。
+# loaded 旗標讓「載入失敗得到 None」維持原本的一次性語意（不重試）
+_LOAD_LOCK = threading.Lock()
+_EMBEDDER = None
+_EMBEDDER_LOADED = False
+_SENTIMENT = None
+_SENTIMENT_LOADED = False
+
+
+def _get_embedder():
+    global _EMBEDDER, _EMBEDDER_LOADED
+    if not _EMBEDDER_LOADED:
+        with _LOAD_LOCK:
+            if not _EMBEDDER_LOADED:
+                model = load_embedder()
+                if model is not None:
+                    model = _maybe_quantize(model)
+                _EMBEDDER = model
+                _EMBEDDER_LOADED = True
+    return _EMBEDDER
+
+
+def _get_sentiment_analyzer():
+    global _SENTIMENT, _SENTIMENT_LOADED
+    if not _SENTIMENT_LOADED:
+        with _LOAD_LOCK:
+            if not _SENTIMENT_LOADED:
+                analyzer = load_sentiment_analyzer()
+                if analyzer is not None:
+                    analyzer.model = _maybe_quantize(analyzer.model)
+                _SENTIMENT = analyzer
+                _SENTIMENT_LOADED = True
+    return _SENTIMENT
+
+# MiniLM-L12-v2 的輸出維度（DB 裡的 embedding bytes 以此 reshape）
+EMBED_DIM = 384
+
+
+def encode_texts(texts):
+    """批次把文字編碼成 float16 numpy 矩陣（寫入 DB 或直接計算用）"""
+    if not texts:
+        return None
+    embedder = _get_embedder()
+    if not embedder:
+        return None
+    emb = embedder.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(emb, dtype=np.float16)
 
 # ────────────────────────────────
 # 產生評論向量並儲存
@@ -59,69 +142,167 @@ def encode_reviews_to_vector(reviews, save_path=None):
     if not texts:
         return None
 
-    embeddings = embedder.encode(texts, convert_to_tensor=True, show_progress_bar=False)
+    embeddings = _get_embedder().encode(texts, convert_to_tensor=True, show_progress_bar=False)
 
     if save_path:
+        import torch
+
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         torch.save(embeddings, save_path)
     return embeddings
 
 
+@functools.lru_cache(maxsize=256)
+def _embed_preferences(prefs: tuple):
+    """把偏好 tuple 編碼成正規化後的向量（同一組偏好只跑一次 encoder）
+
+    偏好在單次推薦流程裡對每間餐廳都相同，逐餐廳重編碼純屬浪費；
+    以 tuple 當 key 快取，連同一位使用者的重複查詢也一併命中。
+    """
+    pref_text = "，".join(prefs) if prefs else "一般用餐體驗"
+    pref_emb = _get_embedder().encode([pref_text], convert_to_numpy=True).astype(np.float32)
+    pref_emb /= np.linalg.norm(pref_emb, axis=1, keepdims=True) + 1e-12
+    return pref_emb
+
+
 # ────────────────────────────────
 # 分析評論內容與偏好語意
 # ────────────────────────────────
-def analyze_reviews(reviews, preferences):
-    """根據偏好語意分析餐廳評論匹配程度與正面率"""
-    if not reviews:
-        return {
-            "summary": "無評論資料",
-            "match_score": 0.0,
-            "positive_rate": 0.0,
-        }
+def analyze_reviews(reviews, preferences, embeddings=None):
+    """根據偏好語意分析餐廳評論匹配程度與正面率
+
+    embeddings: 選填的預先算好的評論向量矩陣（與有 text 的評論逐列對應），
+                快取命中時傳入可完全跳過評論端的 encoder
+    """
+    return analyze_reviews_batch([reviews], preferences, [embeddings])[0]
+
+
+def analyze_reviews_batch(review_lists, preferences, embeddings_list=None):
+    """批次分析多間餐廳的評論（encoder 與 sentiment 模型各只前向一次）
+
+    逐間呼叫 analyze_reviews 會讓模型做 N 次小批次前向；這裡把所有餐廳的
+    評論帶 offset 串成一批，模型呼叫次數與餐廳數脫鉤，之後再按 offset
+    切回各餐廳計算分數與摘要。
+
+    Args:
+        review_lists: 每間餐廳的評論 list（元素格式同 analyze_reviews）
+        preferences: 使用者偏好列表
+        embeddings_list: 選填，與 review_lists 對應的預算向量矩陣（缺的填 None）
+    Returns:
+        List[Dict]: 與輸入順序對應的分析結果
+    """
+    n = len(review_lists)
+    results = [None] * n
+    if embeddings_list is None:
+        embeddings_list = [None] * n
+    else:
+        embeddings_list = list(embeddings_list)
+
+    texts_per = []
+    for i, reviews in enumerate(review_lists):
+        texts = [r.get("text", "") for r in (reviews or []) if r.get("text")]
+        texts_per.append(texts)
+        if not reviews:
+            results[i] = {
+                "summary": "無評論資料",
+                "match_score": 0.0,
+                "positive_rate": 0.0,
+            }
 
-    review_texts = [r.get("text", "") for r in reviews if r.get("text")]
-    
     # 如果沒有 embedder，使用 fallback
+    embedder = _get_embedder()
     if not embedder:
         print("[WARN] Embedder 未初始化，使用 fallback 分析")
-        return {
-            "summary": " / ".join(review_texts[:3]),
-            "match_score": 0.5,  # 給予中等分數
-            "positive_rate": 0.5,
-        }
-    
-    review_emb = embedder.encode(review_texts, convert_to_tensor=True, show_progress_bar=False)
+        for i, texts in enumerate(texts_per):
+            if results[i] is None:
+                results[i] = {
+                    "summary": " / ".join(texts[:3]),
+                    "match_score": 0.5,  # 給予中等分數
+                    "positive_rate": 0.5,
+                }
+        return results
 
-    # 對偏好進行 embedding
-    pref_text = "，".join(preferences) if preferences else "一般用餐體驗"
-    pref_emb = embedder.encode([pref_text], convert_to_tensor=True)
+    # 對偏好進行 embedding（同一輪對話的偏好固定不變，直接吃 lru_cache）
+    pref_emb = _embed_preferences(tuple(preferences or []))
 
-    # 語意相似度
-    sim_scores = util.cos_sim(pref_emb, review_emb).cpu().numpy().flatten()
-    match_score = float(np.mean(sim_scores)) if len(sim_scores) > 0 else 0.0
+    # 缺向量的餐廳統一收進同一個 encode 呼叫，之後按 offset 切回
+    encode_idx = [
+        i for i in range(n)
+        if results[i] is None
+        and (embeddings_list[i] is None or len(embeddings_list[i]) != len(texts_per[i]))
+    ]
+    if encode_idx:
+        flat_texts = [t for i in encode_idx for t in texts_per[i]]
+        if flat_texts:
+            encoded = embedder.encode(
+                flat_texts, convert_to_numpy=True, show_progress_bar=False
+            ).astype(np.float32)
+            offset = 0
+            for i in encode_idx:
+                count = len(texts_per[i])
+                embeddings_list[i] = encoded[offset: offset + count]
+                offset += count
 
-    # 計算正向評論比例
-    if sentiment_analyzer:
+    # sentiment 同樣整批送（每間最多取 50 則），再按 offset 切回
+    sent_counts = [
+        min(len(texts_per[i]), 50) if results[i] is None else 0 for i in range(n)
+    ]
+    sentiments_per = [None] * n
+    sentiment_analyzer = _get_sentiment_analyzer() if any(sent_counts) else None
+    if sentiment_analyzer and any(sent_counts):
         try:
-            sentiments = sentiment_analyzer(review_texts[:50])  # 限制最多 50 則加速
-            positive_count = sum(1 for s in sentiments if s["label"].lower().startswith("pos"))
-            positive_rate = positive_count / len(sentiments) if sentiments else 0.0
+            flat = [t for i in range(n) for t in texts_per[i][: sent_counts[i]]]
+            # 依長度排序後再送模型：同一個 mini-batch 裡長度相近，
+            # padding token 大幅減少（encoder 端 SentenceTransformer 已內建同招）
+            order = sorted(range(len(flat)), key=lambda j: len(flat[j]))
+            sorted_out = sentiment_analyzer([flat[j] for j in order], batch_size=32)
+            sentiments = [None] * len(flat)
+            for j, s in zip(order, sorted_out):
+                sentiments[j] = s
+            offset = 0
+            for i in range(n):
+                sentiments_per[i] = sentiments[offset: offset + sent_counts[i]]
+                offset += sent_counts[i]
         except Exception as e:
             print(f"[WARN] Sentiment 分析失敗：{e}")
-            positive_rate = 0.5  # fallback
-    else:
-        positive_rate = 0.5  # 無 sentiment analyzer 時給予中等分數
-
-    # 摘要：取最相關三句評論
-    top_idx = np.argsort(sim_scores)[-10:][::-1]
-    top_reviews = [review_texts[i] for i in top_idx]
-    summary = " / ".join(top_reviews)
-
-    return {
-        "summary": summary,
-        "match_score": round(match_score, 3),
-        "positive_rate": round(positive_rate, 3),
-    }
+            sentiments_per = [None] * n  # fallback
+
+    for i in range(n):
+        if results[i] is not None:
+            continue
+        review_texts = texts_per[i]
+        if not review_texts:
+            results[i] = {"summary": "", "match_score": 0.0, "positive_rate": 0.5}
+            continue
+        review_emb = np.asarray(embeddings_list[i], dtype=np.float32)
+
+        # 語意相似度（正規化後一次矩陣乘法算完全部 cosine）
+        review_norm = review_emb / (np.linalg.norm(review_emb, axis=1, keepdims=True) + 1e-12)
+        sim_scores = (pref_emb @ review_norm.T).flatten()
+        match_score = float(np.mean(sim_scores)) if len(sim_scores) > 0 else 0.0
+
+        # 計算正向評論比例
+        sentiments = sentiments_per[i]
+        if sentiments:
+            positive_count = sum(1 for s in sentiments if s["label"].lower().startswith("pos"))
+            positive_rate = positive_count / len(sentiments)
+        else:
+            positive_rate = 0.5  # 無 sentiment analyzer 或分析失敗時給予中等分數
+
+        # 摘要：argpartition 先選出 top-k（O(N)），只對這 k 筆排序
+        k = min(10, len(sim_scores))
+        top_idx = np.argpartition(sim_scores, -k)[-k:]
+        top_idx = top_idx[np.argsort(sim_scores[top_idx])[::-1]]
+        top_reviews = [review_texts[j] for j in top_idx]
+        summary = " / ".join(top_reviews)
+
+        results[i] = {
+            "summary": summary,
+            "match_score": round(match_score, 3),
+            "positive_rate": round(positive_rate, 3),
+        }
+
+    return results
 
 
 # ────────────────────────────────
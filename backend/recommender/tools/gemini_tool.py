@@ -1,30 +1,58 @@
 from langchain.tools import BaseTool
 from typing import Optional, Type
 from pydantic import BaseModel, Field
-import google.generativeai as genai
+import functools
+import hashlib
+import json
 import os
-import time
 from dotenv import load_dotenv
 
 # ────────────────────────────────
-# 初始化 Gemini
+# 初始化 Gemini（延遲到首次呼叫）
 # ────────────────────────────────
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
 
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY 未設定，請在 .env 或系統環境變數中設置。")
 
-genai.configure(api_key=GEMINI_API_KEY)
+@functools.lru_cache(maxsize=1)
+def _get_genai():
+    """首次呼叫才 import 並 configure google.generativeai
+
+    SDK 的 import 連帶拉進 grpc 等重量級相依、要一秒上下；
+    延到真的要打 API 才付，import 本模組變成近乎零成本。
+    缺 key 的錯誤也跟著延後到呼叫時才拋。
+    """
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY 未設定，請在 .env 或系統環境變數中設置。")
+    import google.generativeai as genai
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai
 
 
 # ────────────────────────────────
 # 重點函式：生成推薦理由
 # ────────────────────────────────
+# 推薦理由快取：同一間餐廳 + 同一組偏好 + 同一份評論摘要跨請求反覆出現
+# （評論快取命中時摘要完全相同），命中就省掉一整趟 LLM 往返與 token 費用
+_REASON_CACHE: dict = {}
+_REASON_CACHE_MAX = 2048
+
+
+def _reason_cache_key(name, summary, preferences) -> bytes:
+    raw = f"{name}|{'、'.join(sorted(preferences or []))}|{summary or ''}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+
 def generate_reason(name, summary, preferences=None, match_score=None):
     preferences = preferences or []
     pref_text = "、".join(preferences) if preferences else "一般用餐需求"
 
+    cache_key = _reason_cache_key(name, summary, preferences)
+    cached = _REASON_CACHE.get(cache_key)
+    if cached:
+        return cached
+
     prompt = f"""
 你是一位貼心的美食顧問，請根據以下資訊為使用者生成推薦理由。
 
@@ -39,18 +67,88 @@ def generate_reason(name, summary, preferences=None, match_score=None):
     """
 
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
+        model = _get_genai().GenerativeModel("gemini-2.5-flash")
         response = model.generate_content(prompt)
         if hasattr(response, "text") and response.text:
-            return response.text.strip()
+            text = response.text.strip()
         elif hasattr(response, "candidates"):
-            return response.candidates[0].content.parts[0].text.strip()
+            text = response.candidates[0].content.parts[0].text.strip()
         else:
             return f"{name} 很符合你喜歡的『{pref_text}』氛圍，值得一試！"
+        # 只快取真正由模型生成的理由，fallback 文字不進快取
+        if len(_REASON_CACHE) < _REASON_CACHE_MAX:
+            _REASON_CACHE[cache_key] = text
+        return text
     except Exception as e:
         print(f"⚠️ Gemini 生成失敗：{e}")
-        time.sleep(1)
         return f"{name} 的風格很符合你想要的『{pref_text}』氛圍，值得一試！"
+def generate_reasons_batch(items, preferences=None):
+    """
+    一次 Gemini 呼叫生成多間餐廳的推薦理由（取代逐間呼叫的 N 次往返）。
+    Args:
+        items: [{"place_id": ..., "name": ..., "summary": ...}, ...]
+        preferences: 使用者偏好列表
+    Returns:
+        dict: {place_id: 推薦理由文字}；解析失敗時回傳空 dict，由呼叫端 fallback
+    """
+    preferences = preferences or []
+    pref_text = "、".join(preferences) if preferences else "一般用餐需求"
+
+    # 先收割快取命中的餐廳，prompt 裡只放真正需要生成的
+    reasons = {}
+    miss_items = []
+    for it in items:
+        key = _reason_cache_key(it.get("name"), it.get("summary", ""), preferences)
+        cached = _REASON_CACHE.get(key)
+        if cached:
+            reasons[str(it.get("place_id"))] = cached
+        else:
+            miss_items.append((key, it))
+    if not miss_items:
+        return reasons
+
+    lines = []
+    for _key, it in miss_items:
+        lines.append(
+            f"- id: {it.get('place_id')}\n"
+            f"  餐廳名稱: {it.get('name')}\n"
+            f"  評論摘要: {it.get('summary', '')}"
+        )
+
+    prompt = f"""
+你是一位貼心的美食顧問，使用者偏好是：{pref_text}。
+以下是多間餐廳的資料，請為「每一間」生成 2~3 句自然流暢的繁體中文推薦理由，
+語氣親切、自然，明確說出該餐廳為何符合使用者偏好（如氣氛、口味、CP值等）。
+
+{chr(10).join(lines)}
+
+請只輸出一個 JSON 物件，key 是各餐廳的 id，value 是推薦理由文字，例如：
+{{"<id1>": "理由...", "<id2>": "理由..."}}
+不要輸出其他文字或 markdown 標記。
+    """
+
+    try:
+        model = _get_genai().GenerativeModel("gemini-2.5-flash")
+        response = model.generate_content(
+            prompt,
+            generation_config={"response_mime_type": "application/json"},
+        )
+        raw = response.text.strip() if hasattr(response, "text") and response.text else ""
+        data = json.loads(raw)
+        for key, it in miss_items:
+            v = data.get(str(it.get("place_id")))
+            if v:
+                text = str(v).strip()
+                reasons[str(it.get("place_id"))] = text
+                if len(_REASON_CACHE) < _REASON_CACHE_MAX:
+                    _REASON_CACHE[key] = text
+        return reasons
+    except Exception as e:
+        print(f"⚠️ Gemini 批次生成失敗：{e}")
+        # 快取命中的部分照樣回傳，缺漏的由呼叫端逐間 fallback
+        return reasons
+
+
 def call_gemini(prompt: str, model: str = "gemini-2.5-flash", temperature: float = 0.3) -> str:
     """
     呼叫 Gemini 模型，回傳純文字內容。
@@ -62,13 +160,40 @@ def call_gemini(prompt: str, model: str = "gemini-2.5-flash", temperature: float
         str: 模型回傳的文字結果。
     """
     try:
-        gemini_model = genai.GenerativeModel(model)
+        gemini_model = _get_genai().GenerativeModel(model)
         response = gemini_model.generate_content(prompt, generation_config={"temperature": temperature})
         return response.text.strip()
     except Exception as e:
         print(f"⚠️ Gemini 呼叫失敗: {e}")
         return ""
 
+def call_gemini_json(prompt: str, schema: dict = None,
+                     model: str = "gemini-2.5-flash", temperature: float = 0.3):
+    """
+    呼叫 Gemini 並要求模型層級保證輸出合法 JSON（structured output）。
+    Args:
+        prompt (str): 要輸入的提示字串。
+        schema (dict): 選填的 response_schema，讓解碼時直接套用 JSON 結構。
+        model (str): 模型名稱。
+        temperature (float): 生成溫度。
+    Returns:
+        解析後的 Python 物件；呼叫或解析失敗時回傳 None。
+    """
+    config = {
+        "temperature": temperature,
+        "response_mime_type": "application/json",
+    }
+    if schema:
+        config["response_schema"] = schema
+
+    try:
+        gemini_model = _get_genai().GenerativeModel(model)
+        response = gemini_model.generate_content(prompt, generation_config=config)
+        return json.loads(response.text)
+    except Exception as e:
+        print(f"⚠️ Gemini JSON 呼叫失敗: {e}")
+        return None
+
 # ────────────────────────────────
 # LangChain Tool 包裝
 # ────────────────────────────────
@@ -9,7 +9,13 @@
 """
 
 import os
+import threading
+import time
+import orjson
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
@@ -21,79 +27,215 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GOOGLE_PLACE_API_KEY"
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY 未設定，請在 .env 或系統環境變數中設置。")
 
+# 模組層級共用一條 Session：對 Google Maps 主機保留連線池，
+# 每次呼叫不再重付 TCP + TLS 握手（一次搜尋 20+ 個請求只握一次手），
+# 並對暫時性錯誤（429 / 5xx）自動退避重試
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+    ),
+))
+
+# ────────────────────────────────
+# 地理編碼（帶快取）
+# ────────────────────────────────
+# 同一個 location 在一次推薦流程裡會被範圍檢查與餐廳搜尋各編碼一次，
+# 使用者也常反覆查同一地點；快取後重複的 Geocoding 往返與配額直接省掉。
+# 查無結果也快取（negative cache），網路錯誤不快取、下次可重試。
+# 過期採 stale-while-revalidate：超過 TTL 先回舊值，背景執行緒重抓，
+# Geocoding 延遲永遠不落在請求的關鍵路徑上
+_GEOCODE_CACHE: dict = {}
+_GEOCODE_CACHE_MAX = 1024
+_GEOCODE_TTL = 48 * 3600  # 地理資料近乎靜態，48 小時重驗一次綽綽有餘
+_GEO_NOT_FOUND = object()
+
+_GEO_REFRESH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="geo-refresh")
+_GEO_REFRESHING: set = set()
+_GEO_REFRESH_LOCK = threading.Lock()
+
+
+def _geocode_fetch(location: str):
+    """實際打 Geocoding API（不碰快取）
+
+    返回：
+        (lat, lng, viewport): 編碼成功
+        _GEO_NOT_FOUND: API 回覆查無此地點
+        None: 逾時或網路錯誤
+    """
+    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
+    geo_params = {
+        "address": location,
+        "key": GOOGLE_API_KEY,
+        "language": "zh-TW"
+    }
+    try:
+        # orjson 直接吃 bytes，比 resp.json() 的 stdlib 解析快數倍
+        data = orjson.loads(_SESSION.get(geocode_url, params=geo_params, timeout=10).content)
+    except requests.exceptions.ReadTimeout:
+        print(f"地理編碼逾時：{location}")
+        return None
+    except Exception as e:
+        print(f"地理編碼失敗：{e}")
+        return None
+
+    if data.get("status") != "OK" or not data.get("results"):
+        print(f"無法解析地點：{location}（status={data.get('status')}）")
+        return _GEO_NOT_FOUND
+    geometry = data["results"][0].get("geometry", {})
+    loc = geometry.get("location", {})
+    return (loc.get("lat"), loc.get("lng"), geometry.get("viewport"))
+
+
+def _geocode_refresh(location: str) -> None:
+    """背景重抓一筆過期的地理編碼（失敗就保留舊值，下次再試）"""
+    try:
+        result = _geocode_fetch(location)
+        if result is not None:
+            _GEOCODE_CACHE[location] = (result, time.time())
+    finally:
+        with _GEO_REFRESH_LOCK:
+            _GEO_REFRESHING.discard(location)
+
+
+def _geocode(location: str):
+    """地理編碼共用入口（讀穿快取 + 過期背景重驗）
+
+    返回：
+        (lat, lng, viewport): 編碼成功
+        _GEO_NOT_FOUND: API 回覆查無此地點
+        None: 逾時或網路錯誤（不進快取）
+    """
+    cached = _GEOCODE_CACHE.get(location)
+    if cached is not None:
+        result, fetched_at = cached
+        if time.time() - fetched_at > _GEOCODE_TTL:
+            # 先回舊值，重抓交給背景執行緒（同一地點只排一次）
+            with _GEO_REFRESH_LOCK:
+                if location not in _GEO_REFRESHING:
+                    _GEO_REFRESHING.add(location)
+                    _GEO_REFRESH_POOL.submit(_geocode_refresh, location)
+        return result
+
+    result = _geocode_fetch(location)
+    if result is not None and len(_GEOCODE_CACHE) < _GEOCODE_CACHE_MAX:
+        _GEOCODE_CACHE[location] = (result, time.time())
+    return result
+
+
 # ────────────────────────────────
 # 檢查地點是否過大
 # ────────────────────────────────
+# 已知台灣行政區快查表：縣市層級的輸入根本不用問 Geocoding 就知道太大，
+# 直接短路省一趟 API。基隆/新竹/嘉義三個市面積小、viewport 差距低於
+# 0.2 度門檻，歸為可搜尋；「新竹」「嘉義」不帶後綴時縣市不分，不收錄。
+# 表上查不到的照走 geocode 判斷
+_TW_ADMIN_TOO_LARGE = {
+    "台北市": True, "臺北市": True, "台北": True, "臺北": True,
+    "新北市": True, "新北": True,
+    "桃園市": True, "桃園": True,
+    "台中市": True, "臺中市": True, "台中": True, "臺中": True,
+    "台南市": True, "臺南市": True, "台南": True, "臺南": True,
+    "高雄市": True, "高雄": True,
+    "宜蘭縣": True, "宜蘭": True,
+    "新竹縣": True,
+    "苗栗縣": True, "苗栗": True,
+    "彰化縣": True, "彰化": True,
+    "南投縣": True, "南投": True,
+    "雲林縣": True, "雲林": True,
+    "嘉義縣": True,
+    "屏東縣": True, "屏東": True,
+    "花蓮縣": True, "花蓮": True,
+    "台東縣": True, "臺東縣": True, "台東": True, "臺東": True,
+    "澎湖縣": True, "澎湖": True,
+    "金門縣": True, "金門": True,
+    "連江縣": True,
+    "基隆市": False, "基隆": False,
+    "新竹市": False,
+    "嘉義市": False,
+}
+
+# 鄉鎮市區層級的後綴：這個粒度的地點必然在可搜尋範圍內
+_TW_SMALL_SUFFIXES = ("區", "鄉", "鎮")
+
+
 def location_is_too_large(location: str) -> bool:
     """
     根據地點的經緯度範圍判斷是否過大。
     若查到的地理邊界差距（lat/lng）任一超過 0.2 度，視為範圍過廣。
+    已知的縣市/鄉鎮市區名稱先查本地表，不打 API。
     若 API 請求逾時或失敗，則回傳 False（避免中斷流程）。
     """
     if not location:
         return True
 
-    api_key = GOOGLE_API_KEY
-    if not api_key:
-        print("⚠️ 未設定 GOOGLE_API_KEY，跳過範圍檢查。")
+    norm = location.strip()
+    verdict = _TW_ADMIN_TOO_LARGE.get(norm)
+    if verdict is not None:
+        return verdict
+    if norm.endswith(_TW_SMALL_SUFFIXES):
         return False
 
-    try:
-        url = f"https://maps.googleapis.com/maps/api/geocode/json?address={location}&key={api_key}"
-        resp = requests.get(url, timeout=10)  
-        data = resp.json()
-
-        if data.get("status") != "OK" or not data.get("results"):
-            print(f"無法解析地點：{location}（status={data.get('status')}）")  # 📝 加上 log
-            return True
-
-        geometry = data["results"][0].get("geometry", {})
-        viewport = geometry.get("viewport")
-
-        if viewport:
-            lat_diff = abs(viewport["northeast"]["lat"] - viewport["southwest"]["lat"])
-            lng_diff = abs(viewport["northeast"]["lng"] - viewport["southwest"]["lng"])
-            print(f"範圍差距 lat={lat_diff:.3f}, lng={lng_diff:.3f}")
-
-            return lat_diff > 0.2 or lng_diff > 0.2
-
+    if not GOOGLE_API_KEY:
+        print("⚠️ 未設定 GOOGLE_API_KEY，跳過範圍檢查。")
         return False
 
-    except requests.exceptions.ReadTimeout:
-        print("Google API 連線逾時，略過範圍檢查。") 
+    geo = _geocode(location)
+    if geo is None:
         return False
+    if geo is _GEO_NOT_FOUND:
+        return True
 
-    except Exception as e:
-        print(f"檢查地點範圍時發生錯誤：{e}")
-        return False
+    viewport = geo[2]
+    if viewport:
+        lat_diff = abs(viewport["northeast"]["lat"] - viewport["southwest"]["lat"])
+        lng_diff = abs(viewport["northeast"]["lng"] - viewport["southwest"]["lng"])
+        print(f"範圍差距 lat={lat_diff:.3f}, lng={lng_diff:.3f}")
+        return lat_diff > 0.2 or lng_diff > 0.2
+
+    return False
 
 
 # ────────────────────────────────
 # 搜尋餐廳
 # ────────────────────────────────
-import requests
-def search_restaurants(location: str, category: str, radius: int = 2000, max_results: int = 10):
-    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
-    geo_params = {
-        "address": location,
-        "key": GOOGLE_API_KEY,
-        "language": "zh-TW"
+def _fetch_details(place_id: str) -> dict:
+    """查單一餐廳的 Place Details；失敗回傳空 dict，不中斷整批搜尋"""
+    details_url = "https://maps.googleapis.com/maps/api/place/details/json"
+    details_params = {
+        "place_id": place_id,
+        "fields": "formatted_address,formatted_phone_number,website,opening_hours,price_level,url",
+        "language": "zh-TW",
+        "key": GOOGLE_API_KEY
     }
     try:
-        geo_res = requests.get(geocode_url, params=geo_params, timeout=10).json()  
+        details_res = orjson.loads(_SESSION.get(details_url, params=details_params, timeout=10).content)
     except requests.exceptions.ReadTimeout:
-        print(f"地理編碼逾時：{location}") 
-        return []
+        print(f"Details 逾時：{place_id}")
+        return {}
     except Exception as e:
-        print(f"地理編碼失敗：{e}")
-        return []
+        print(f"Details 查詢錯誤：{e}")
+        return {}
 
-    if geo_res.get("status") != "OK":
-        print(f"地理編碼失敗：{geo_res.get('status')}")  
+    if details_res.get("status") != "OK":
+        print(f"Details 回傳非 OK：{details_res.get('status')}")
+    return details_res.get("result", {})
+
+
+def search_restaurants(location: str, category: str, radius: int = 2000, max_results: int = 10):
+    # 範圍檢查通常剛查過同一個 location，這裡多半直接命中 _geocode 快取
+    geo = _geocode(location)
+    if geo is None or geo is _GEO_NOT_FOUND:
+        print(f"地理編碼失敗：{location}")
         return []
 
-    lat = geo_res["results"][0]["geometry"]["location"]["lat"]
-    lng = geo_res["results"][0]["geometry"]["location"]["lng"]
+    lat, lng = geo[0], geo[1]
 
     nearby_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
     nearby_params = {
@@ -106,7 +248,7 @@ def search_restaurants(location: str, category: str, radius: int = 2000, max_res
     }
 
     try:
-        res = requests.get(nearby_url, params=nearby_params, timeout=10).json()  
+        res = orjson.loads(_SESSION.get(nearby_url, params=nearby_params, timeout=10).content)
     except requests.exceptions.ReadTimeout:
         print(f"餐廳搜尋逾時：{location} {category}")
         return []
@@ -122,35 +264,16 @@ def search_restaurants(location: str, category: str, radius: int = 2000, max_res
         print(f"餐廳搜尋失敗：{status}") 
         return []
 
-    restaurants = []
-    for item in res.get("results", [])[:max_results]:
-        place_id = item.get("place_id")
-        if not place_id:
-            continue
-
-        # Place Details 拿完整資料
-        details_url = "https://maps.googleapis.com/maps/api/place/details/json"
-        details_params = {
-            "place_id": place_id,
-            "fields": "formatted_address,formatted_phone_number,website,opening_hours,price_level,url",
-            "language": "zh-TW",
-            "key": GOOGLE_API_KEY
-        }
-        try:
-            details_res = requests.get(details_url, params=details_params, timeout=10).json() 
-        except requests.exceptions.ReadTimeout:
-            print(f"Details 逾時：{place_id}")
-            d = {}
-        except Exception as e:
-            print(f"Details 查詢錯誤：{e}")
-            d = {}
-
-        if details_res.get("status") != "OK":
-            print(f"Details 回傳非 OK：{details_res.get('status')}")  
-            d = details_res.get("result", {})
-        else:
-            d = details_res.get("result", {})
+    items = [it for it in res.get("results", [])[:max_results] if it.get("place_id")]
+
+    # Details 是純 I/O 等待：逐筆串行要付 N 次往返延遲，
+    # 丟進執行緒池同時發出，整段耗時從 N×RTT 縮成約一次 RTT
+    with ThreadPoolExecutor(max_workers=min(8, max(len(items), 1))) as pool:
+        details = list(pool.map(_fetch_details, [it["place_id"] for it in items]))
 
+    restaurants = []
+    for item, d in zip(items, details):
+        place_id = item["place_id"]
         restaurants.append({
             "name": item.get("name"),
             "place_id": place_id,
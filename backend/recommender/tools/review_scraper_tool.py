@@ -1,17 +1,95 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
 import re
-import json
+import orjson
 import time
+import threading
+import requests
 from typing import Optional, Type, List, Dict, Any
 from pydantic import BaseModel, Field
 from langchain.tools import BaseTool
-from playwright.sync_api import sync_playwright
+
+
+# 檔名清洗用的 pattern：編譯一次，省掉每次呼叫查 re 內部快取
+_FNAME_RE = re.compile(r'[\\/*?:"<>|]')
 
 
 def sanitize_filename(name: str) -> str:
     """移除不合法字元（若未來要用）"""
-    return re.sub(r'[\\/*?:"<>|]', "", name).strip()
+    return _FNAME_RE.sub("", name).strip()
+
+
+# 每個執行緒留住自己的常駐瀏覽器：sync Playwright 物件綁定建立它的
+# 執行緒，無法跨執行緒共用，但抓評論的 worker 是常駐池，讓每個 worker
+# 重複使用同一個 Chromium 行程，~1-2 秒的冷啟動成本從每間餐廳一次
+# 攤提成每個 worker 一次。行程結束時 Chromium 子行程會跟著父行程終止
+_THREAD = threading.local()
+
+# 評論解析用的選擇器與星等 regex：整個迴圈共用，不在每則評論重建
+_REVIEW_SELECTOR = "div[data-review-id]"
+_TEXT_SELECTOR = "span.wiI7pd, span[jsname='bN97Pc']"
+_STARS_SELECTOR = "span[aria-label*='星']"
+_STAR_RE = re.compile(r'(\d(\.\d)?)')
+
+# 頁面載入時直接擋掉的資源：評論抓取只需要 DOM 文字，
+# 圖片/影音/字型與追蹤腳本佔了大部分傳輸量
+_BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+_BLOCKED_URL_PARTS = (
+    "doubleclick.net",
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+)
+
+_BROWSER_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--disable-infobars",
+    "--window-size=1280,800",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+]
+
+
+def _thread_browser(headless: bool = True):
+    """取得本執行緒的常駐瀏覽器（首次呼叫或斷線時啟動）"""
+    browser = getattr(_THREAD, "browser", None)
+    if browser is not None and getattr(_THREAD, "headless", None) == headless:
+        try:
+            if browser.is_connected():
+                return browser
+        except Exception:
+            pass
+    # 斷線或 headless 設定不同：收掉舊的重新啟動。
+    # playwright 延到這裡才 import：走 Places API 快速路徑的行程
+    # 完全不用付 driver 的 import 成本
+    from playwright.sync_api import sync_playwright
+
+    _close_thread_browser()
+    _THREAD.playwright = sync_playwright().start()
+    _THREAD.browser = _THREAD.playwright.chromium.launch(
+        headless=headless, args=_BROWSER_ARGS
+    )
+    _THREAD.headless = headless
+    return _THREAD.browser
+
+
+def _close_thread_browser() -> None:
+    """關閉本執行緒的瀏覽器與 Playwright driver（失敗就放給行程回收）"""
+    browser = getattr(_THREAD, "browser", None)
+    if browser is not None:
+        try:
+            browser.close()
+        except Exception:
+            pass
+        _THREAD.browser = None
+    pw = getattr(_THREAD, "playwright", None)
+    if pw is not None:
+        try:
+            pw.stop()
+        except Exception:
+            pass
+        _THREAD.playwright = None
 
 
 # 核心爬蟲
@@ -22,30 +100,20 @@ def scrape_reviews_tw(place_id: str, max_reviews: int = 100, duration_limit: int
 
     reviews, seen = [], set()
 
-    with sync_playwright() as p:
-        # Headless Anti-detection 
-        browser = p.chromium.launch(
-            headless=headless,
-            args=[
-                "--disable-blink-features=AutomationControlled",
-                "--disable-infobars",
-                "--window-size=1280,800",
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-            ]
-        )
+    browser = _thread_browser(headless)
 
-        context = browser.new_context(
-            locale="zh-TW",
-            user_agent=(
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/120.0.0.0 Safari/537.36"
-            ),
-            viewport={"width": 1280, "height": 800},
-            java_script_enabled=True,
-        )
+    context = browser.new_context(
+        locale="zh-TW",
+        user_agent=(
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/120.0.0.0 Safari/537.36"
+        ),
+        viewport={"width": 1280, "height": 800},
+        java_script_enabled=True,
+    )
 
+    try:
         # 讓 Google 無法偵測 headless
         context.add_init_script("""
             Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
@@ -53,11 +121,16 @@ def scrape_reviews_tw(place_id: str, max_reviews: int = 100, duration_limit: int
 
         page = context.new_page()
 
-        # 阻擋圖片
+        # 阻擋用不到的資源：圖片/影音/字型與第三方追蹤請求都只是
+        # 浪費頻寬與載入時間，評論文字全在 DOM 裡。stylesheet 不擋，
+        # 滾動分頁依賴容器的版面高度，砍掉 CSS 會讓 scrollHeight 失真
         page.route(
             "**/*",
             lambda route: route.abort()
-            if route.request.resource_type in ["image", "media"]
+            if (
+                route.request.resource_type in _BLOCKED_RESOURCE_TYPES
+                or any(h in route.request.url for h in _BLOCKED_URL_PARTS)
+            )
             else route.continue_(),
         )
 
@@ -71,55 +144,86 @@ def scrape_reviews_tw(place_id: str, max_reviews: int = 100, duration_limit: int
             btn.click()
             print("已點擊評論按鈕")
             page.wait_for_timeout(2000)
-            page.wait_for_selector("div[data-review-id]", timeout=15000)
+            page.wait_for_selector(_REVIEW_SELECTOR, timeout=15000)
         except Exception as e:
             print(f"找不到評論按鈕或超時: {e}")
-            context.close()
-            browser.close()
             return []
 
         print(f"正在滾動評論（最長 {duration_limit} 秒）...")
 
+        # 滾動與計數合成同一個 evaluate：回傳已載入的評論數，
+        # 不必為了計數再多打一趟 locator.count() 的往返
         scroll_script = """
-        () => {
+        (reviewSel) => {
             const el = document.querySelector('div.m6QErb.DxyBCb.kA9KIf.dS8AEf.XiKgde');
-            if (!el) return 0;
-            el.scrollTo(0, el.scrollHeight);
-            return el.scrollTop;
+            if (el) el.scrollTo(0, el.scrollHeight);
+            return document.querySelectorAll(reviewSel).length;
         }
         """
 
+        # 評論數連續三輪沒成長就提前收工：評論少的店不用枯等滿
+        # duration_limit。間隔從 150ms 起跳，遇到停滯才退避到 500ms
         start_time = time.time()
-        while len(reviews) < max_reviews and (time.time() - start_time < duration_limit):
-            page.evaluate(scroll_script)
-            page.wait_for_timeout(500)
+        last_count, no_new, wait_ms = 0, 0, 150
+        while time.time() - start_time < duration_limit:
+            count = page.evaluate(scroll_script, _REVIEW_SELECTOR)
+            if count >= max_reviews:
+                break
+            if count == last_count:
+                no_new += 1
+                wait_ms = min(wait_ms * 2, 500)
+                if no_new >= 3:
+                    print(f"評論數停在 {count} 則，提前結束滾動")
+                    break
+            else:
+                no_new = 0
+                wait_ms = 150
+            last_count = count
+            page.wait_for_timeout(wait_ms)
 
-        # 抓取評論
-        elements = page.locator("div[data-review-id]")
+        # 抓取評論：一個 evaluate 在瀏覽器端掃完所有評論節點。
+        # 逐則 nth(i).inner_text()/get_attribute() 每次都是一趟 CDP 往返，
+        # 數百則評論就是上千次 IPC；整批拉回來後在 Python 端解析星等與去重
         print("正在解析評論...")
+        try:
+            raw_reviews = page.evaluate(
+                """([reviewSel, textSel, starsSel]) =>
+                    Array.from(document.querySelectorAll(reviewSel)).map(el => {
+                        const textEl = el.querySelector(textSel);
+                        const starsEl = el.querySelector(starsSel);
+                        return {
+                            text: textEl ? textEl.innerText : null,
+                            stars: starsEl ? starsEl.getAttribute('aria-label') : null,
+                        };
+                    })
+                """,
+                [_REVIEW_SELECTOR, _TEXT_SELECTOR, _STARS_SELECTOR],
+            )
+        except Exception as e:
+            print(f"解析評論失敗：{e}")
+            raw_reviews = []
 
-        for i in range(elements.count()):
-            try:
-                el = elements.nth(i)
-                text = el.locator("span.wiI7pd, span[jsname='bN97Pc']").first.inner_text(timeout=500)
-
-                stars_raw = el.locator("span[aria-label*='星']").first.get_attribute("aria-label")
-                match = re.search(r'(\d(\.\d)?)', stars_raw or "")
-                stars = float(match.group(1)) if match else None
-
-                if text not in seen:
-                    seen.add(text)
-                    reviews.append({"text": text.strip(), "stars": stars})
-
-                    if len(reviews) >= max_reviews:
-                        break
-            except:
+        for rv in raw_reviews:
+            text = rv.get("text")
+            if not text:
+                continue
+            # 去重用 8-byte 指紋而非整段文字：set 只存定長 digest，
+            # 省掉幾百字長字串的重複雜湊與駐留記憶體
+            fp = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+            if fp in seen:
                 continue
+            match = _STAR_RE.search(rv.get("stars") or "")
+            stars = float(match.group(1)) if match else None
+            seen.add(fp)
+            reviews.append({"text": text.strip(), "stars": stars})
+            if len(reviews) >= max_reviews:
+                break
 
         print(f" 完成：共 {len(reviews)} 則評論")
-        context.close()
-        browser.close()
         return reviews
+    finally:
+        # 只收 context，瀏覽器留給同執行緒的下一次呼叫
+        context.close()
 
 # ────────────────────────────────
 # LangChain Tool 包裝
@@ -142,10 +246,66 @@ class ReviewScraperTool(BaseTool):
     async def _arun(self, **kwargs):
         raise NotImplementedError("不支援 async")
 
+# ────────────────────────────────
+# Places API 評論（免瀏覽器的快速路徑）
+# ────────────────────────────────
+def fetch_reviews_api(place_id: str) -> Optional[List[Dict[str, Any]]]:
+    """用 Place Details 的 reviews 欄位直接拿評論（最多 5 則）
+
+    一個 HTTPS GET（~150ms）就能取回結構化評論，成本比啟動 Chromium
+    爬頁面低了幾個數量級；只是 API 上限 5 則，量不夠時仍得用爬蟲。
+
+    返回：
+        List[Dict]: {"text", "stars"} 列表（可能為空）
+        None: 未設定 API key 或呼叫失敗（呼叫端自行決定 fallback）
+    """
+    api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GOOGLE_PLACE_API_KEY")
+    if not api_key:
+        return None
+
+    url = "https://maps.googleapis.com/maps/api/place/details/json"
+    params = {
+        "place_id": place_id,
+        "fields": "reviews",
+        "language": "zh-TW",
+        "key": api_key,
+    }
+    try:
+        data = orjson.loads(requests.get(url, params=params, timeout=10).content)
+    except Exception as e:
+        print(f"Places 評論 API 失敗：{e}")
+        return None
+
+    if data.get("status") != "OK":
+        print(f"Places 評論 API 回傳非 OK：{data.get('status')}")
+        return None
+
+    reviews = []
+    for rv in data.get("result", {}).get("reviews", []):
+        text = (rv.get("text") or "").strip()
+        if text:
+            reviews.append({"text": text, "stars": rv.get("rating")})
+    return reviews
+
+
 # 提供給 Agent 呼叫
 def get_all_reviews(place_name: str, place_id: str, max_reviews: int = 100) -> List[Dict[str, Any]]:
+    # 只需要 5 則以內時，一個 API 呼叫就夠，完全不碰瀏覽器
+    if max_reviews <= 5:
+        api_reviews = fetch_reviews_api(place_id)
+        if api_reviews:
+            return api_reviews[:max_reviews]
+
     try:
-        return scrape_reviews_tw(place_id, max_reviews=max_reviews)
+        reviews = scrape_reviews_tw(place_id, max_reviews=max_reviews)
     except Exception as e:
         print(f"抓取 {place_name} 失敗：{e}")
-        return []
+        reviews = []
+
+    # 爬蟲掛掉或一無所獲時，退回 API 的 5 則聊勝於無
+    if not reviews:
+        api_reviews = fetch_reviews_api(place_id)
+        if api_reviews:
+            print(f"改用 Places API 評論（{len(api_reviews)} 則）：{place_name}")
+            return api_reviews
+    return reviews
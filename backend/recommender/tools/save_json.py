@@ -3,8 +3,8 @@
 安全儲存資料為 UTF-8 JSON 檔案。
 """
 
-import json
 import os
+import orjson
 from langchain.tools import tool  # ✅ 支援 LangGraph 節點
 
 
@@ -20,8 +20,12 @@ def save_json(data: dict, path: str) -> dict:
     """
     try:
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # orjson 一次 dumps 成 bytes 後單次寫入，比 json.dump 逐段編碼快數倍
+        payload = orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        )
+        with open(path, "wb") as f:
+            f.write(payload)
         print(f"💾 已儲存 {path}")
         return {"success": True, "path": path}
     except Exception as e:
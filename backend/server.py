@@ -2,12 +2,22 @@ import sys, os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import asyncio
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 
 from recommender.recommend_agent import build_recommend_graph
 
+
+async def send_payload(ws: WebSocket, payload: dict) -> None:
+    """送出一個 JSON frame（orjson 序列化，比 send_json 的 stdlib json 快數倍）
+
+    推薦結果 frame 夾帶整批摘要與理由、可達數十 KB，序列化成本有感；
+    仍走文字 frame，前端的 JSON.parse(e.data) 不用動。
+    """
+    await ws.send_text(orjson.dumps(payload).decode("utf-8"))
+
 app = FastAPI()
 
 # Serve frontend directory
@@ -97,7 +107,7 @@ async def chat(ws: WebSocket):
                                     progress_msg = progress_msgs[next_node]
                                     if progress_msg:  # 只有非空字串才發送
                                         try:
-                                            await ws.send_json({
+                                            await send_payload(ws, {
                                                 "type": "progress",
                                                 "text": progress_msg
                                             })
@@ -109,7 +119,7 @@ async def chat(ws: WebSocket):
                                 msg = node_output["message"]
                                 if msg and not msg.startswith("為你推薦"):
                                     try:
-                                        await ws.send_json({
+                                        await send_payload(ws, {
                                             "type": "message",
                                             "text": msg
                                         })
@@ -121,13 +131,13 @@ async def chat(ws: WebSocket):
                     print(f"[WebSocket] 發送推薦數量：{len(state['recommendations'])}")
                     
                     # 先顯示推薦訊息
-                    await ws.send_json({
+                    await send_payload(ws, {
                         "type": "message",
                         "text": "右側為你們的推薦結果"
                     })
                     
                     # 再發送卡片
-                    await ws.send_json({
+                    await send_payload(ws, {
                         "type": "recommendations", 
                         "data": state["recommendations"]
                     })
@@ -139,7 +149,7 @@ async def chat(ws: WebSocket):
                 print(f"[WebSocket] 執行圖時發生錯誤：{e}")
                 import traceback
                 traceback.print_exc()
-                await ws.send_json({
+                await send_payload(ws, {
                     "type": "error",
                     "text": f"處理請求時發生錯誤：{str(e)}"
                 })